@@ -0,0 +1,100 @@
+"""Per-row cost of serializing read responses before and after the trusted-read path.
+
+The "before" path is what a read route returning models costs: building the
+model from the document, then FastAPI dumping it, validating it again against
+response_model and encoding it with json.dumps. The "after" path projects the
+document on the response fields and encodes it with orjson.
+
+    python benchmarks/bench_serialization.py --rows 100 --iterations 200
+
+Documents are generated in memory, no database is needed.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import List
+
+from pydantic import TypeAdapter
+
+ROOT_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from models import Equipment, OfficeElement, User  # noqa: E402
+from serialization import dumps, project  # noqa: E402
+
+
+def user(index: int) -> dict:
+    return {
+        "id": str(uuid.uuid4()), "name": f"Utilisateur {index}", "email": f"user{index}@example.com",
+        "role": "Utilisateur", "department": "IT", "status": "Actif", "phone": "01 23 45 67 89", "last_login": datetime.utcnow(),
+        "created_at": datetime.utcnow(), "updated_at": datetime.utcnow(),
+        "search_terms": ["utilisateur", str(index)],
+    }
+
+
+def equipment(index: int) -> dict:
+    return {
+        "id": str(uuid.uuid4()), "name": f"Ordinateur {index}", "type": "Ordinateur",
+        "serial_number": f"SN-{index:08d}", "status": "En service", "assigned_to": "Jean Dupont",
+        "location": "Bureau 101", "purchase_date": datetime.utcnow(), "warranty": datetime.utcnow(), "value": 1200.0,
+        "created_at": datetime.utcnow(), "updated_at": datetime.utcnow(),
+        "search_terms": ["ordinateur", str(index)],
+    }
+
+
+def element(index: int) -> dict:
+    return {
+        "id": str(uuid.uuid4()), "name": f"Bureau {index}", "type": "desk", "x": index * 10.0, "y": 40.0,
+        "width": 120.0, "height": 60.0, "rotation": 0, "status": "available", "assigned_to": None,
+        "properties": {"color": "#8B4513", "capacity": 1}, "office_plan_id": "plan",
+        "cells": ["0:0"], "bounds": {"min_x": 0, "min_y": 0, "max_x": 120, "max_y": 60},
+    }
+
+
+SCENARIOS = {
+    "User": (User, user),
+    "Equipment": (Equipment, equipment),
+    "OfficeElement": (OfficeElement, element),
+}
+
+
+def before(model, adapter: TypeAdapter, documents: List[dict]) -> bytes:
+    models = [model(**document) for document in documents]
+    validated = adapter.validate_python([instance.model_dump() for instance in models])
+    return json.dumps(adapter.dump_python(validated, mode="json")).encode()
+
+
+def after(model, documents: List[dict]) -> bytes:
+    return dumps([project(document, model) for document in documents])
+
+
+def per_row_us(run, rows: int, iterations: int) -> float:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start) * 1e6 / rows)
+    return statistics.median(timings)
+
+
+def main(rows: int, iterations: int):
+    print(f"{'model':<16}{'before':>10}{'after':>10}{'speedup':>10}  (us per row, median)")
+    for name, (model, generate) in SCENARIOS.items():
+        documents = [generate(index) for index in range(rows)]
+        adapter = TypeAdapter(List[model])
+        before_us = per_row_us(lambda: before(model, adapter, documents), rows, iterations)
+        after_us = per_row_us(lambda: after(model, documents), rows, iterations)
+        print(f"{name:<16}{before_us:>10.1f}{after_us:>10.1f}{before_us / after_us:>9.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark read response serialization")
+    parser.add_argument("--rows", type=int, default=100)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    main(args.rows, args.iterations)
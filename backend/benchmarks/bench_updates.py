@@ -0,0 +1,198 @@
+"""Latency of the update routes' write paths before and after find_one_and_update.
+
+The "before" path is the find_one / update_one / find_one sequence the routes
+used to run. The "after" path is the one they run now, through the same
+helpers: the find_one_and_update with its search terms pipeline, the counters
+$inc and, for plans and elements, the version bump, history and change feed.
+update_plan_element also reads the element's geometry and checks collisions
+first. The after path therefore includes the bookkeeping added since, not
+only the saved round trips.
+
+    python benchmarks/bench_updates.py --iterations 500
+
+Runs against a scratch database named after DB_NAME, dropped at the end.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+
+ROOT_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+import counters  # noqa: E402
+import plan_history  # noqa: E402
+from collisions import GEOMETRY_PROJECTION, find_collisions  # noqa: E402
+from indexes import ensure_indexes  # noqa: E402
+from models import OfficeElement, OfficePlan  # noqa: E402
+from plan_changes import log_changes, plan_changed  # noqa: E402
+from search import search_update, with_search_terms  # noqa: E402
+from spatial import GEOMETRY_FIELDS, spatial_fields, with_spatial_fields  # noqa: E402
+
+DOCUMENTS_PER_COLLECTION = 1000
+PLANS = 10
+PLAN_SIZE = 1500
+ELEMENT_SPACING = 150  # Desks laid out on a grid, 100 per plan
+
+# Same stage as routes/office_plans.py
+_BUMP_VERSION = {"$set": {"version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}}}
+
+
+async def seed(db):
+    """Documents of every collection, with the search terms, spatial fields and history the routes expect"""
+    await ensure_indexes(db)
+    now = datetime.utcnow()
+    for collection in ("users", "groups", "equipments"):
+        await db[collection].insert_many([with_search_terms(collection, {
+            "id": f"{collection}-{index}",
+            "name": f"Document {index}",
+            "email": f"user{index}@example.com",
+            "serial_number": f"SN-{index}",
+            "status": "Disponible",
+            "created_at": now,
+        }) for index in range(DOCUMENTS_PER_COLLECTION)])
+    await db.users.insert_one({"id": "assignee", "name": "Jean Dupont", "email": "jean@example.com"})
+
+    plans = [OfficePlan(id=f"plan-{index}", name=f"Plan {index}", width=PLAN_SIZE, height=PLAN_SIZE,
+                        created_by="Jean Dupont").dict(exclude={"elements"}) for index in range(PLANS)]
+    await db.office_plans.insert_many([with_search_terms("office_plans", plan) for plan in plans])
+    per_row = PLAN_SIZE // ELEMENT_SPACING
+    await db.office_elements.insert_many([
+        with_spatial_fields({**OfficeElement(
+            id=f"plan-{plan}-element-{index}", name=f"Bureau {index}", type="desk",
+            x=(index % per_row) * ELEMENT_SPACING, y=(index // per_row) * ELEMENT_SPACING,
+            width=80, height=40, office_plan_id=f"plan-{plan}"
+        ).dict(), "updated_at": now})
+        for plan in range(PLANS) for index in range(per_row * per_row)
+    ])
+    for plan in plans:
+        await plan_history.snapshot(db, plan)
+    await counters.rebuild_counters(db)
+
+    return {
+        "users": [{"id": f"users-{index}"} for index in range(DOCUMENTS_PER_COLLECTION)],
+        "groups": [{"id": f"groups-{index}"} for index in range(DOCUMENTS_PER_COLLECTION)],
+        "equipments": [{"id": f"equipments-{index}"} for index in range(DOCUMENTS_PER_COLLECTION)],
+        "office_plans": [{"id": plan["id"]} for plan in plans],
+        "office_elements": await db.office_elements.find({}, {"_id": 0, "id": 1, "office_plan_id": 1}).to_list(None),
+    }
+
+
+async def before(db, collection, document, update_data):
+    document_id = document["id"]
+    found = await db[collection].find_one({"id": document_id})
+    await db[collection].update_one({"id": document_id}, {"$set": update_data})
+    updated = await db[collection].find_one({"id": document_id})
+    return found, updated
+
+
+async def update_document(db, collection, document, update_data):
+    """update_user, update_group, update_equipment and unassign_equipment"""
+    found = await db[collection].find_one_and_update(
+        {"id": document["id"]},
+        search_update(collection, update_data),
+        return_document=ReturnDocument.BEFORE
+    )
+    await counters.record_change(db, collection, found, {**found, **update_data})
+
+
+async def update_last_login(db, collection, document, update_data):
+    await db.users.find_one_and_update({"id": document["id"]}, {"$set": update_data}, projection={"_id": 1})
+    await counters.apply_delta(db, counters.revision_delta("users"))
+
+
+async def assign_equipment(db, collection, document, update_data):
+    user = await db.users.find_one({"id": "assignee"}, {"name": 1})
+    await update_document(db, collection, document, {**update_data, "assigned_to": user["name"]})
+
+
+async def update_office_plan(db, collection, document, update_data):
+    plan = await db.office_plans.find_one_and_update(
+        {"id": document["id"]},
+        search_update("office_plans", update_data) + [_BUMP_VERSION],
+        return_document=ReturnDocument.BEFORE
+    )
+    updated_plan = {**plan, **update_data, "version": plan.get("version", 0) + 1}
+    await counters.record_change(db, "office_plans", plan, updated_plan)
+    await log_changes(db, plan["id"], updated_plan["version"], [{"op": "plan", "changes": update_data}])
+
+
+async def update_plan_element(db, collection, document, update_data):
+    """Geometry read, collision check, guarded write with the spatial fields, counters and plan version"""
+    query = {"id": document["id"], "office_plan_id": document["office_plan_id"]}
+    element = await db.office_elements.find_one(query, GEOMETRY_PROJECTION)
+    geometry = {**element, **update_data}
+    # The write goes ahead whatever the outcome, as with force=true
+    await find_collisions(db, document["office_plan_id"], [geometry])
+    spatial = spatial_fields(geometry)
+    query.update({field: element.get(field) for field in GEOMETRY_FIELDS if field not in update_data})
+    found = await db.office_elements.find_one_and_update(
+        query, {"$set": {**update_data, **spatial}}, return_document=ReturnDocument.BEFORE
+    )
+    if found is None:
+        return
+    changes = {field: value for field, value in update_data.items() if field != "updated_at"}
+    await counters.record_change(db, "office_elements", found, {**found, **update_data, **spatial})
+    await plan_changed(db, document["office_plan_id"], [{"op": "update", "id": document["id"], "changes": changes}])
+
+
+# Route -> (collection, fields set by the route, path it runs now)
+SCENARIOS = {
+    "update_user": ("users", {"department": "IT"}, update_document),
+    "update_last_login": ("users", {"last_login": None}, update_last_login),
+    "update_group": ("groups", {"description": "Benchmark"}, update_document),
+    "update_equipment": ("equipments", {"location": "Bureau 101"}, update_document),
+    "assign_equipment": ("equipments", {"assigned_to": "Jean Dupont", "status": "En service"}, assign_equipment),
+    "unassign_equipment": ("equipments", {"assigned_to": None, "status": "Disponible"}, update_document),
+    "update_office_plan": ("office_plans", {"background_color": "#ffffff"}, update_office_plan),
+    "update_plan_element": (
+        "office_elements",
+        lambda: {"x": random.uniform(0, PLAN_SIZE), "y": random.uniform(0, PLAN_SIZE)},
+        update_plan_element,
+    ),
+}
+
+
+async def measure(path, db, collection, documents, fields, iterations):
+    latencies = []
+    for _ in range(iterations):
+        update_data = {**(fields() if callable(fields) else fields), "updated_at": datetime.utcnow()}
+        if collection == "users" and "last_login" in update_data:
+            update_data["last_login"] = update_data["updated_at"]
+        start = time.perf_counter()
+        await path(db, collection, random.choice(documents), update_data)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.95) - 1]
+
+
+async def main(iterations: int):
+    load_dotenv(ROOT_DIR / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME'] + "_bench_updates"]
+    try:
+        documents = await seed(db)
+        print(f"{'route':<22}{'before p50':>12}{'after p50':>12}{'before p95':>12}{'after p95':>12}  (ms)")
+        for route, (collection, fields, after) in SCENARIOS.items():
+            before_p50, before_p95 = await measure(before, db, collection, documents[collection], fields, iterations)
+            after_p50, after_p95 = await measure(after, db, collection, documents[collection], fields, iterations)
+            print(f"{route:<22}{before_p50:>12.3f}{after_p50:>12.3f}{before_p95:>12.3f}{after_p95:>12.3f}")
+    finally:
+        await client.drop_database(db.name)
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the update routes' write paths")
+    parser.add_argument("--iterations", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.iterations))
@@ -0,0 +1,167 @@
+"""Overlap detection between office elements.
+
+The broad phase fetches, in a single query served by the spatial grid index,
+the elements sharing a grid cell with any of the elements being written, then
+buckets everything in an in-memory grid so each written element is only
+compared with its neighbours. The exact phase runs the separating axis test
+on the rotated rectangles. Checking N moved elements therefore costs about
+O(N + neighbours) rather than O(N²) comparisons.
+"""
+from collections import defaultdict
+from typing import Dict, Iterable, List
+
+from models import OfficeElementType
+from spatial import MAX_CELLS, OVERSIZED_CELL, bounding_box, box_filter, cell_keys, corners
+
+# Floor areas and openings can overlap anything, chairs are drawn at desks
+IGNORED_TYPES = {
+    OfficeElementType.FOUNDATION.value,
+    OfficeElementType.RECEPTION.value,
+    OfficeElementType.BATHROOM.value,
+    OfficeElementType.STORAGE.value,
+    OfficeElementType.DOOR.value,
+    OfficeElementType.WINDOW.value,
+    OfficeElementType.CHAIR.value,
+}
+
+# Walls meet and cross at corners
+SELF_OVERLAPPING_TYPES = {OfficeElementType.WALL.value}
+
+# Overlaps thinner than this are edges touching
+EPSILON = 1e-6
+
+GEOMETRY_PROJECTION = {"_id": 0, "id": 1, "type": 1, "x": 1, "y": 1, "width": 1, "height": 1, "rotation": 1}
+
+
+def _type(element: dict) -> str:
+    value = element["type"]
+    return getattr(value, "value", value)
+
+
+def can_collide(a: dict, b: dict) -> bool:
+    type_a, type_b = _type(a), _type(b)
+    if type_a in IGNORED_TYPES or type_b in IGNORED_TYPES:
+        return False
+    return not (type_a == type_b and type_a in SELF_OVERLAPPING_TYPES)
+
+
+def _projection(points, axis):
+    values = [px * axis[0] + py * axis[1] for px, py in points]
+    return min(values), max(values)
+
+
+def overlaps(a: dict, b: dict) -> bool:
+    """Separating axis test between the rotated rectangles of a and b"""
+    points_a, points_b = corners(a), corners(b)
+    for points in (points_a, points_b):
+        # A rectangle has two distinct edge normals
+        for (x0, y0), (x1, y1) in zip(points[:2], points[1:3]):
+            axis = (y0 - y1, x1 - x0)
+            min_a, max_a = _projection(points_a, axis)
+            min_b, max_b = _projection(points_b, axis)
+            length = (axis[0] ** 2 + axis[1] ** 2) ** 0.5 or 1
+            if min(max_a, max_b) - max(min_a, min_b) <= EPSILON * length:
+                return False
+    return True
+
+
+def _boxes_intersect(a, b) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+class _Grid:
+    """In-memory grid bucketing elements by the cells their bounds overlap"""
+
+    def __init__(self):
+        self.cells = defaultdict(list)
+        self.large = []
+        self.boxes = {}
+
+    def add(self, element: dict):
+        box = bounding_box(element)
+        self.boxes[element["id"]] = box
+        keys = cell_keys(box, MAX_CELLS)
+        if keys is None:
+            self.large.append(element)
+        else:
+            for key in keys:
+                self.cells[key].append(element)
+
+    def neighbours(self, element: dict) -> Iterable[dict]:
+        keys = cell_keys(self.boxes[element["id"]], MAX_CELLS)
+        if keys is None:
+            buckets = list(self.cells.values())
+        else:
+            buckets = [self.cells.get(key, []) for key in keys]
+        seen = set()
+        for bucket in buckets + [self.large]:
+            for other in bucket:
+                if other["id"] not in seen:
+                    seen.add(other["id"])
+                    yield other
+
+
+async def find_collisions(db, plan_id: str, elements: List[dict], excluded_ids: Iterable[str] = ()) -> Dict[str, List[str]]:
+    """Map the id of every element of elements overlapping another one to the ids it overlaps
+
+    elements hold the geometry about to be written. Stored versions of those
+    elements and of excluded_ids (elements being deleted) are ignored.
+    """
+    written = [element for element in elements if _type(element) not in IGNORED_TYPES]
+    if not written:
+        return {}
+
+    # Broad phase: stored elements sharing a grid cell with a written element
+    cells = {OVERSIZED_CELL}
+    large_boxes = []
+    for element in written:
+        box = bounding_box(element)
+        keys = cell_keys(box, MAX_CELLS)
+        if keys is None:
+            large_boxes.append(box_filter(box))
+        else:
+            cells.update(keys)
+    ignored_ids = {element["id"] for element in written} | set(excluded_ids)
+    stored = await db.office_elements.find({
+        "office_plan_id": plan_id,
+        "id": {"$nin": list(ignored_ids)},
+        "type": {"$nin": list(IGNORED_TYPES)},
+        "$or": [{"cells": {"$in": list(cells)}}, *large_boxes]
+    }, GEOMETRY_PROJECTION).to_list(None)
+
+    grid = _Grid()
+    for element in stored + written:
+        grid.add(element)
+
+    # Exact phase on neighbours only
+    collisions = {}
+    for element in written:
+        box = grid.boxes[element["id"]]
+        conflicts = [
+            other["id"] for other in grid.neighbours(element)
+            if other["id"] != element["id"]
+            and _boxes_intersect(box, grid.boxes[other["id"]])
+            and can_collide(element, other)
+            and overlaps(element, other)
+        ]
+        if conflicts:
+            collisions[element["id"]] = sorted(conflicts)
+    return collisions
+
+
+async def batch_collisions(db, plan_id: str, elements: List[dict], excluded_ids: Iterable[str] = ()) -> Dict[str, List[str]]:
+    """Collisions of the elements of a batch that can't be written, as find_collisions reports them
+
+    A rejected element stays where it is stored, so the others are checked
+    again against that place until no more element is rejected.
+    """
+    remaining = {element["id"]: element for element in elements}
+    rejected = {}
+    while remaining:
+        collisions = await find_collisions(db, plan_id, list(remaining.values()), excluded_ids)
+        if not collisions:
+            break
+        for element_id, conflicts in collisions.items():
+            rejected[element_id] = conflicts
+            del remaining[element_id]
+    return rejected
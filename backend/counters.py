@@ -0,0 +1,167 @@
+"""Incrementally maintained statistics counters.
+
+Every write route reports the documents it created, deleted or changed, and
+the matching counters of the ``counters`` collection are moved with a single
+atomic ``$inc``. ``rebuild_counters`` recomputes them from the source
+collections; running this module directly does so and reports the drift:
+
+    python counters.py            # rebuild and report drift
+    python counters.py --dry-run  # only report drift
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from models import Statistics
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path(__file__).parent
+
+COUNTERS_ID = "statistics"
+
+# Per-collection write revisions, kept in the counters document so a write
+# moves them with the same $inc, see etags.list_etag
+REVISIONS_FIELD = "revisions"
+
+COUNTER_NAMES = list(Statistics.model_fields)
+
+# Counter contributions of a single document, per collection
+CONTRIBUTIONS = {
+    "users": lambda user: {
+        "total_users": 1,
+        "active_users": int(user.get("status") == "Actif"),
+    },
+    "groups": lambda group: {
+        "total_groups": 1,
+    },
+    "equipments": lambda equipment: {
+        "total_equipments": 1,
+        "equipments_in_service": int(equipment.get("status") == "En service"),
+        "equipments_available": int(equipment.get("status") == "Disponible"),
+        "equipments_in_maintenance": int(equipment.get("status") == "En maintenance"),
+    },
+    "office_plans": lambda plan: {
+        "total_office_plans": int(plan.get("is_active") is True),
+    },
+    "office_elements": lambda element: {
+        "total_office_elements": 1,
+        "available_desks": int(element.get("type") == "desk" and element.get("status") == "available"),
+        "occupied_desks": int(element.get("type") == "desk" and element.get("status") == "occupied"),
+    },
+}
+
+
+def counter_delta(collection, document, sign=1):
+    """Counter changes caused by adding (sign > 0) or removing (sign < 0) documents"""
+    return {name: value * sign for name, value in CONTRIBUTIONS[collection](document).items()}
+
+
+def merge_deltas(*deltas):
+    merged = {}
+    for delta in deltas:
+        for name, value in delta.items():
+            merged[name] = merged.get(name, 0) + value
+    return merged
+
+
+async def apply_delta(db, delta):
+    """Apply counter changes with a single atomic $inc"""
+    delta = {name: value for name, value in delta.items() if value}
+    if delta:
+        await db.counters.update_one({"_id": COUNTERS_ID}, {"$inc": delta}, upsert=True)
+
+
+def revision_delta(*collections):
+    """Increment the write revision of collections"""
+    return {f"{REVISIONS_FIELD}.{collection}": 1 for collection in collections}
+
+
+def change_delta(collection, before=None, after=None):
+    """Counter changes for a document created (no before), deleted (no after) or updated"""
+    deltas = []
+    if before is not None:
+        deltas.append(counter_delta(collection, before, -1))
+    if after is not None:
+        deltas.append(counter_delta(collection, after))
+    return merge_deltas(*deltas)
+
+
+async def record_change(db, collection, before=None, after=None):
+    await apply_delta(db, merge_deltas(change_delta(collection, before, after), revision_delta(collection)))
+
+
+async def grouped_delta(db, collection, query, sign=1):
+    """Counter changes for every document matching query, grouped server side"""
+    rows = await db[collection].aggregate([
+        {"$match": query},
+        {"$group": {"_id": {"type": "$type", "status": "$status", "is_active": "$is_active"}, "count": {"$sum": 1}}}
+    ]).to_list(None)
+    return merge_deltas(*[counter_delta(collection, row["_id"], sign * row["count"]) for row in rows])
+
+
+async def read_counters(db):
+    """Return the current counters, or None if they were never built"""
+    counters = await db.counters.find_one({"_id": COUNTERS_ID})
+    if counters is None:
+        return None
+    return Statistics(**{name: counters.get(name, 0) for name in COUNTER_NAMES})
+
+
+async def compute_from_sources(db):
+    """Recompute every counter from the source collections"""
+    deltas = await asyncio.gather(*[
+        grouped_delta(db, collection, {}) for collection in CONTRIBUTIONS
+    ])
+    totals = merge_deltas(*deltas)
+    return Statistics(**{name: totals.get(name, 0) for name in COUNTER_NAMES})
+
+
+async def rebuild_counters(db, dry_run=False):
+    """Rebuild the counters from the source collections and return the drift per counter"""
+    current = await read_counters(db)
+    expected = await compute_from_sources(db)
+    current_values = current.dict() if current else {}
+    drift = {
+        name: value - current_values.get(name, 0)
+        for name, value in expected.dict().items()
+        if value != current_values.get(name, 0)
+    }
+    if not dry_run and (drift or current is None):
+        await db.counters.update_one({"_id": COUNTERS_ID}, {"$set": expected.dict()}, upsert=True)
+    return drift
+
+
+async def ensure_counters(db):
+    """Build the counters on first start"""
+    if await read_counters(db) is None:
+        logger.info("Building statistics counters...")
+        await rebuild_counters(db)
+
+
+async def _main(dry_run: bool) -> int:
+    load_dotenv(ROOT_DIR / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        drift = await rebuild_counters(db, dry_run=dry_run)
+        for name, value in drift.items():
+            print(f"{name}: {value:+d}")
+        print("counters drifted" if drift else "counters are consistent")
+        return 1 if drift else 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild statistics counters")
+    parser.add_argument("--dry-run", action="store_true", help="only report drift, do not rewrite the counters")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_main(args.dry_run)))
@@ -0,0 +1,88 @@
+"""Strong ETags and conditional GETs.
+
+Tags are derived from metadata the routes already read or can read with one
+small indexed lookup, so a request whose If-None-Match still matches gets a
+304 without loading or serializing the resource:
+
+- a plan, its elements and its history are tagged with the plan ``version``,
+  bumped by every write to the plan or its elements;
+- users, groups and equipment are tagged with the fields every write to them
+  changes, mostly ``updated_at``;
+- list responses are tagged with the revision of the collections they read,
+  incremented with the statistics counters by every write (see
+  ``counters.revision_delta``), and with the query string.
+"""
+import hashlib
+from typing import Optional
+
+from fastapi import Request, Response
+
+from counters import COUNTERS_ID, REVISIONS_FIELD
+
+# Fields changed by every write to a document, per collection
+TAGGED_FIELDS = {
+    "users": ("updated_at", "last_login"),
+    "groups": ("updated_at", "members"),
+    "equipments": ("updated_at",),
+}
+
+
+def make_etag(*parts) -> str:
+    digest = hashlib.blake2b("|".join(str(part) for part in parts).encode(), digest_size=12).hexdigest()
+    return f'"{digest}"'
+
+
+def document_etag(collection: str, document: dict, request: Optional[Request] = None) -> str:
+    """Tag of a document representation, varying with the query string when request is given"""
+    return make_etag(
+        collection, document["id"], *(document.get(field) for field in TAGGED_FIELDS[collection]),
+        request.url.query if request else ""
+    )
+
+
+def plan_etag(plan_id: str, version: int, request: Optional[Request] = None) -> str:
+    """Tag of a plan representation at version, varying with the query string when request is given"""
+    return make_etag("office_plans", plan_id, version, request.url.query if request else "")
+
+
+async def _revisions(db, collections) -> list:
+    counters = await db.counters.find_one(
+        {"_id": COUNTERS_ID},
+        {f"{REVISIONS_FIELD}.{collection}": 1 for collection in collections}
+    )
+    revisions = (counters or {}).get(REVISIONS_FIELD, {})
+    return [revisions.get(collection, 0) for collection in collections]
+
+
+async def list_etag(db, request: Request, *collections: str) -> str:
+    """Tag of a list response reading collections, from their revisions"""
+    return make_etag(*collections, *await _revisions(db, collections), request.url.query)
+
+
+async def with_revisions(db, etag: str, *collections: str) -> str:
+    """Tag of a representation tagged etag that also embeds documents of collections"""
+    return make_etag(etag, *collections, *await _revisions(db, collections))
+
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """A 304 response when the client already holds the representation tagged etag"""
+    if _matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
+
+
+def check(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """Tag response with etag, or return a 304 when the client already holds that representation"""
+    unchanged = not_modified(request, etag)
+    if unchanged is None:
+        response.headers["ETag"] = etag
+    return unchanged
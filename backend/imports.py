@@ -0,0 +1,247 @@
+"""Bulk imports of users and equipment from CSV or JSON files.
+
+Rows are parsed lazily from the file, validated against the create model in
+batches of IMPORT_BATCH_SIZE and inserted with one unordered insert_many per
+batch. Duplicate emails and serial numbers, within the file or with existing
+documents, are rejected by the unique indexes rather than looked up row by
+row. The report lists the rows that failed and the throughput.
+
+JSON files hold either one object per line or an array of objects. A
+malformed line is reported and skipped, while a malformed array ends the
+import. Running this module directly imports a local file:
+
+    python imports.py equipments assets.csv
+    python imports.py users people.json --batch-size 2000
+"""
+import argparse
+import asyncio
+import codecs
+import csv
+import io
+import json
+import logging
+import os
+import re
+import sys
+import time
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+
+import counters
+from models import Equipment, EquipmentCreate, ImportReport, ImportRowError, User, UserCreate
+from search import with_search_terms
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path(__file__).parent
+
+IMPORT_BATCH_SIZE = 1000
+READ_SIZE = 64 * 1024
+MAX_ROW_SIZE = 1024 * 1024  # Characters of a JSON object
+MAX_REPORTED_ERRORS = 1000
+
+# Collection -> (create model validating rows, stored model)
+IMPORTERS = {
+    "users": (UserCreate, User),
+    "equipments": (EquipmentCreate, Equipment),
+}
+
+DUPLICATE_KEY = 11000
+
+Row = Tuple[int, Optional[dict], Optional[str]]  # row number, values, parse error
+
+
+def detect_format(filename: Optional[str]) -> str:
+    return "csv" if filename and filename.lower().endswith(".csv") else "json"
+
+
+def _csv_rows(file: BinaryIO) -> Iterator[Row]:
+    reader = csv.DictReader(io.TextIOWrapper(file, encoding="utf-8-sig", newline=""))
+    for number, row in enumerate(reader, start=1):
+        # Empty cells fall back to the model defaults
+        yield number, {key: value for key, value in row.items() if key and value not in ("", None)}, None
+
+
+def _truncated(buffer: str, exc: json.JSONDecodeError) -> bool:
+    """Whether decoding buffer failed only because its last value goes on past its end"""
+    rest = buffer[exc.pos:].rstrip()
+    if not rest or exc.msg.startswith("Unterminated string"):
+        return True
+    if exc.msg.startswith("Invalid \\uXXXX escape"):
+        return len(rest) < 6
+    # A literal or a number cut short
+    return any(literal.startswith(rest) for literal in ("true", "false", "null")) or re.fullmatch(r"-?[0-9.eE+-]*", rest) is not None
+
+
+def _json_rows(file: BinaryIO) -> Iterator[Row]:
+    """Objects of a JSON array or of JSON lines, decoded as the file is read
+
+    A malformed line is reported and reading goes on at the next one. In an
+    array the objects after a malformed one can't be found, so it ends the rows.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    number = 0
+    eof = False
+
+    def read() -> bool:
+        """Append the next chunk of the file to buffer, False at its end"""
+        nonlocal buffer, eof
+        if eof:
+            return False
+        chunk = file.read(READ_SIZE)
+        eof = not chunk
+        buffer += text_decoder.decode(chunk, final=eof)
+        return not eof
+
+    while not buffer.strip():
+        if not read():
+            return
+    array = buffer.lstrip().startswith("[")
+    # Whitespace, and the array punctuation, between objects
+    separators = " \t\r\n,[]" if array else " \t\r\n"
+    while True:
+        buffer = buffer.lstrip(separators)
+        if not buffer:
+            if not read():
+                return
+            continue
+        try:
+            value, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError as exc:
+            line_end = -1 if array else buffer.find("\n")
+            # An object cut by the end of the chunk is decoded once the next one is read
+            cut = _truncated(buffer, exc) if array else line_end < 0
+            if cut and len(buffer) <= MAX_ROW_SIZE and read():
+                continue
+            number += 1
+            if len(buffer) > MAX_ROW_SIZE and line_end < 0:
+                yield number, None, f"Row longer than {MAX_ROW_SIZE} characters"
+            else:
+                yield number, None, f"Invalid JSON: {exc.msg}"
+            if array:
+                return
+            # Skip the rest of the line, without keeping it
+            while line_end < 0:
+                buffer = ""
+                if not read():
+                    return
+                line_end = buffer.find("\n")
+            buffer = buffer[line_end + 1:]
+            continue
+        number += 1
+        buffer = buffer[end:]
+        if isinstance(value, dict):
+            yield number, value, None
+        else:
+            yield number, None, "Expected a JSON object"
+
+
+def read_rows(file: BinaryIO, format: str) -> Iterator[Row]:
+    return _csv_rows(file) if format == "csv" else _json_rows(file)
+
+
+def _next_batch(rows: Iterator[Row], size: int) -> List[Row]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            break
+    return batch
+
+
+def _duplicate_message(error: dict) -> str:
+    fields = ", ".join(error.get("keyPattern", {})) or "key"
+    return f"Duplicate {fields}"
+
+
+async def import_rows(db, collection: str, rows: Iterator[Row], batch_size: int = IMPORT_BATCH_SIZE) -> ImportReport:
+    """Validate and insert rows into collection, returning the per-row report
+
+    Parsing runs in a worker thread, as the uploaded file may be read from disk.
+    """
+    create_model, model = IMPORTERS[collection]
+    report = ImportReport(collection=collection)
+    started = time.perf_counter()
+
+    def fail(number: int, message: str):
+        report.failed += 1
+        if len(report.errors) < MAX_REPORTED_ERRORS:
+            report.errors.append(ImportRowError(row=number, message=message))
+
+    while True:
+        batch = await asyncio.to_thread(_next_batch, rows, batch_size)
+        if not batch:
+            break
+        report.received += len(batch)
+
+        numbers, documents = [], []
+        for number, values, error in batch:
+            if error:
+                fail(number, error)
+                continue
+            try:
+                document = model(**create_model(**values).dict()).dict()
+            except ValidationError as exc:
+                fail(number, "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in exc.errors()))
+                continue
+            numbers.append(number)
+            documents.append(document)
+        if not documents:
+            continue
+
+        failed = set()
+        try:
+            await db[collection].insert_many(
+                [with_search_terms(collection, document) for document in documents], ordered=False
+            )
+        except BulkWriteError as exc:
+            for error in exc.details["writeErrors"]:
+                failed.add(error["index"])
+                message = _duplicate_message(error) if error["code"] == DUPLICATE_KEY else error["errmsg"]
+                fail(numbers[error["index"]], message)
+
+        inserted = [document for index, document in enumerate(documents) if index not in failed]
+        report.inserted += len(inserted)
+        await counters.apply_delta(db, counters.merge_deltas(
+            counters.revision_delta(collection) if inserted else {},
+            *[counters.counter_delta(collection, document) for document in inserted]
+        ))
+
+    report.elapsed_seconds = time.perf_counter() - started
+    report.rows_per_second = report.received / report.elapsed_seconds if report.elapsed_seconds else 0
+    return report
+
+
+async def _main(collection: str, path: str, batch_size: int) -> int:
+    load_dotenv(ROOT_DIR / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        with open(path, "rb") as file:
+            report = await import_rows(db, collection, read_rows(file, detect_format(path)), batch_size)
+        for error in report.errors:
+            print(f"row {error.row}: {error.message}")
+        print(
+            f"{report.inserted}/{report.received} rows imported into {collection} "
+            f"in {report.elapsed_seconds:.1f}s ({report.rows_per_second:.0f} rows/s)"
+        )
+        return 1 if report.failed else 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import users or equipment from a CSV or JSON file")
+    parser.add_argument("collection", choices=sorted(IMPORTERS))
+    parser.add_argument("path")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_main(args.collection, args.path, args.batch_size)))
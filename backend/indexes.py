@@ -0,0 +1,340 @@
+"""Index registry for every collection the routes query.
+
+``ensure_indexes`` is applied by ``server.py`` on startup. Running this module
+directly applies the same indexes, and ``--check`` explains every query shape
+listed in ``QUERY_SHAPES`` and reports the ones still answered by a COLLSCAN:
+
+    python indexes.py --check
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, IndexModel, UpdateOne
+from pymongo.errors import OperationFailure
+
+from exports import SINCE_SORT
+from models import OfficeElement
+from pagination import SORT as PAGE_SORT
+from plan_changes import plan_changed
+from search import search_filter
+from spatial import box_filter
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = Path(__file__).parent
+
+# Indexes per collection. Unique indexes back the uniqueness checks done by
+# the create routes. List endpoints sort on the (created_at, id) pagination
+# key, so each filter they support gets an index with that key as suffix.
+INDEXES = {
+    "users": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("email", ASCENDING)], unique=True, name="email_unique"),
+        IndexModel([("name", ASCENDING)], name="name"),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)], name="created_at_id"),
+        IndexModel([("department", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="department_created_at_id"),
+        IndexModel([("role", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="role_created_at_id"),
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="status_created_at_id"),
+        IndexModel([("search_terms", ASCENDING)], name="search_terms"),
+        IndexModel([("updated_at", ASCENDING), ("id", ASCENDING)], name="updated_at_id"),
+    ],
+    "groups": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("name", ASCENDING)], name="name"),
+        IndexModel([("leader", ASCENDING)], name="leader"),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)], name="created_at_id"),
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="status_created_at_id"),
+        IndexModel([("search_terms", ASCENDING)], name="search_terms"),
+        IndexModel([("updated_at", ASCENDING), ("id", ASCENDING)], name="updated_at_id"),
+    ],
+    "group_memberships": [
+        IndexModel([("group_id", ASCENDING), ("user_id", ASCENDING)], unique=True, name="group_user_unique"),
+        IndexModel([("user_id", ASCENDING), ("group_id", ASCENDING)], name="user_group"),
+        IndexModel([("group_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="group_created_at_id"),
+        IndexModel([("user_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="user_created_at_id"),
+    ],
+    "equipments": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("serial_number", ASCENDING)], unique=True, name="serial_number_unique"),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)], name="created_at_id"),
+        IndexModel([("type", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="type_created_at_id"),
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="status_created_at_id"),
+        IndexModel([("assigned_to", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="assigned_to_created_at_id"),
+        IndexModel([("search_terms", ASCENDING)], name="search_terms"),
+        IndexModel([("updated_at", ASCENDING), ("id", ASCENDING)], name="updated_at_id"),
+    ],
+    "office_plans": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("created_by", ASCENDING), ("name", ASCENDING)], name="created_by_name"),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)], name="created_at_id"),
+        IndexModel([("created_by", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="created_by_created_at_id"),
+        IndexModel([("is_active", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="is_active_created_at_id"),
+        IndexModel([("search_terms", ASCENDING)], name="search_terms"),
+    ],
+    "office_elements": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("office_plan_id", ASCENDING), ("id", ASCENDING)], name="plan_id"),
+        IndexModel([("office_plan_id", ASCENDING), ("cells", ASCENDING)], name="plan_cells"),
+        IndexModel([("office_plan_id", ASCENDING), ("updated_at", ASCENDING), ("id", ASCENDING)], name="plan_updated_at_id"),
+        IndexModel([("office_plan_id", ASCENDING), ("type", ASCENDING), ("status", ASCENDING), ("cells", ASCENDING)], name="plan_type_status_cells"),
+        IndexModel([("type", ASCENDING), ("status", ASCENDING)], name="type_status"),
+        IndexModel([("assigned_to", ASCENDING)], name="assigned_to"),
+    ],
+    "plan_operations": [
+        IndexModel([("plan_id", ASCENDING), ("version", ASCENDING)], unique=True, name="plan_version_unique"),
+    ],
+    "plan_snapshots": [
+        IndexModel([("plan_id", ASCENDING), ("version", ASCENDING)], unique=True, name="plan_version_unique"),
+    ],
+    "propagation_jobs": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING)], name="status_created_at"),
+        IndexModel([("user_id", ASCENDING), ("created_at", ASCENDING)], name="user_id_created_at"),
+    ],
+}
+
+# Indexes of earlier versions of the registry, superseded by the ones above
+LEGACY_INDEXES = {
+    "users": ["department_status", "role_status", "status_role"],
+    "groups": ["status"],
+    "equipments": ["type_status", "status_type", "assigned_to"],
+    "office_plans": ["is_active"],
+    "office_elements": ["plan_type_status"],
+}
+
+# Query shapes issued by the routes, as (collection, filter, sort) triples.
+# Values are placeholders: only the shape matters to the planner.
+QUERY_SHAPES = [
+    ("users", {"id": ""}, None),
+    ("users", {"email": ""}, None),
+    ("users", {}, PAGE_SORT),
+    ("users", {"department": ""}, PAGE_SORT),
+    ("users", {"role": ""}, PAGE_SORT),
+    ("users", {"status": ""}, PAGE_SORT),
+    ("users", {"department": "", "role": "", "status": ""}, PAGE_SORT),
+    ("users", search_filter(["a"]), None),
+    ("users", {"updated_at": {"$gte": 0}}, SINCE_SORT),
+    ("users", {"$or": [{"id": {"$in": [""]}}, {"name": {"$in": [""]}}]}, None),
+    ("groups", {"id": ""}, None),
+    ("groups", {"name": ""}, None),
+    ("groups", {"leader": {"$in": [""]}}, None),
+    ("groups", {}, PAGE_SORT),
+    ("groups", {"status": ""}, PAGE_SORT),
+    ("groups", search_filter(["a"]), None),
+    ("groups", {"updated_at": {"$gte": 0}}, SINCE_SORT),
+    ("group_memberships", {"user_id": ""}, None),
+    ("group_memberships", {"group_id": "", "user_id": {"$in": [""]}}, None),
+    ("group_memberships", {"group_id": ""}, PAGE_SORT),
+    ("group_memberships", {"user_id": ""}, PAGE_SORT),
+    ("equipments", {"id": ""}, None),
+    ("equipments", {"serial_number": ""}, None),
+    ("equipments", {}, PAGE_SORT),
+    ("equipments", {"type": ""}, PAGE_SORT),
+    ("equipments", {"status": ""}, PAGE_SORT),
+    ("equipments", {"assigned_to": ""}, PAGE_SORT),
+    ("equipments", {"assigned_to": {"$in": [""]}}, None),
+    ("equipments", {"type": "", "status": "", "assigned_to": ""}, PAGE_SORT),
+    ("equipments", search_filter(["a"]), None),
+    ("equipments", {"updated_at": {"$gte": 0}}, SINCE_SORT),
+    ("equipments", {"status": "", "updated_at": {"$gte": 0}}, SINCE_SORT),
+    ("office_plans", {"id": ""}, None),
+    ("office_plans", {"name": "", "created_by": ""}, None),
+    ("office_plans", {}, PAGE_SORT),
+    ("office_plans", {"created_by": ""}, PAGE_SORT),
+    ("office_plans", {"created_by": {"$in": [""]}}, None),
+    ("office_plans", {"is_active": True}, PAGE_SORT),
+    ("office_plans", search_filter(["a"]), None),
+    ("office_elements", {"id": ""}, None),
+    ("office_elements", {"id": "", "office_plan_id": ""}, None),
+    ("office_elements", {"office_plan_id": ""}, [("id", ASCENDING)]),
+    ("office_elements", {"office_plan_id": "", "updated_at": {"$gte": 0}}, SINCE_SORT),
+    ("office_elements", {"type": "desk", "status": "available"}, None),
+    ("office_elements", {"assigned_to": {"$in": [""]}}, None),
+    ("office_elements", {"office_plan_id": "", **box_filter((0, 0, 1200, 800))}, None),
+    ("office_elements", {"office_plan_id": "", "type": "desk", "status": "available", **box_filter((0, 0, 512, 512))}, None),
+    ("plan_operations", {"plan_id": "", "version": {"$gt": 0, "$lte": 50}}, [("version", ASCENDING)]),
+    ("plan_operations", {"plan_id": "", "version": {"$lt": 50}}, [("version", -1)]),
+    ("plan_snapshots", {"plan_id": "", "version": {"$lte": 50}}, [("version", -1)]),
+    ("propagation_jobs", {"id": ""}, None),
+    ("propagation_jobs", {"status": ""}, [("created_at", ASCENDING)]),
+    ("propagation_jobs", {"user_id": ""}, [("created_at", -1)]),
+]
+
+
+async def _reassign_duplicate_plan_ids(db):
+    """Give every copy of a duplicated plan id but the first its own id, moving its elements along
+
+    The duplicate route of older versions kept the original plan's id, and the
+    copied elements kept theirs. Copies are told apart by insertion order: each
+    later copy of an element goes to the last plan copy inserted before it,
+    elements with a single copy stay with the original. The history and cached
+    bodies of the original are dropped, as they mixed the copies in, and are
+    rebuilt by backfill_plan_snapshots and the next read.
+    """
+    async for group in db.office_plans.aggregate([
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": "$id", "copies": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True):
+        plan_id, copies = group["_id"], group["copies"][1:]
+        # Derived from the _id so an interrupted migration resumes with the same ids
+        new_ids = {copy: f"{plan_id}:{copy}" for copy in copies}
+        updates = []
+        async for element_group in db.office_elements.aggregate([
+            {"$match": {"office_plan_id": plan_id}},
+            {"$sort": {"_id": 1}},
+            {"$group": {"_id": "$id", "copies": {"$push": "$_id"}}},
+        ], allowDiskUse=True):
+            for element_copy in element_group["copies"][1:]:
+                owners = [copy for copy in copies if copy < element_copy]
+                if owners:
+                    updates.append(UpdateOne({"_id": element_copy}, {"$set": {"office_plan_id": new_ids[owners[-1]]}}))
+        if updates:
+            await db.office_elements.bulk_write(updates, ordered=False)
+        await db.office_plans.bulk_write([
+            UpdateOne({"_id": copy}, {"$set": {"id": new_id}}) for copy, new_id in new_ids.items()
+        ], ordered=False)
+        await db.plan_operations.delete_many({"plan_id": plan_id})
+        await db.plan_snapshots.delete_many({"plan_id": plan_id})
+        await db.plan_cache.delete_one({"_id": plan_id})
+        logger.info("Reassigned %d duplicated copies of plan %s", len(copies), plan_id)
+
+
+async def _reassign_duplicate_element_ids(db):
+    """Give every copy of a duplicated element id but the first the id the duplicate route now builds
+
+    Plans duplicated before element ids were unique copied them verbatim. Each
+    reassignment is logged on the copy's plan as a delete and a create.
+    """
+    ops = {}
+    async for group in db.office_elements.aggregate([
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": "$id", "copies": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True):
+        copies = await db.office_elements.find({"_id": {"$in": group["copies"][1:]}}).to_list(None)
+        updates = []
+        for copy in copies:
+            new_id = f"{copy['office_plan_id']}:{copy['_id']}"
+            updates.append(UpdateOne({"_id": copy["_id"]}, {"$set": {"id": new_id}}))
+            ops.setdefault(copy["office_plan_id"], []).extend([
+                {"op": "delete", "id": copy["id"]},
+                {"op": "create", "id": new_id, "element": OfficeElement(**{**copy, "id": new_id}).dict()},
+            ])
+        await db.office_elements.bulk_write(updates, ordered=False)
+    for plan_id, plan_ops in ops.items():
+        logger.info("Reassigned %d duplicated element ids in plan %s", len(plan_ops) // 2, plan_id)
+        await plan_changed(db, plan_id, plan_ops)
+
+
+async def _migrate_element_id_index(db):
+    """Replace the non-unique office_elements id index of older databases by id_unique
+
+    Duplicated element ids are reassigned whenever id_unique is missing,
+    whatever indexes exist. The non-unique index and id_unique have the same
+    key, so they can't coexist: a temporary (id, office_plan_id) index keeps id
+    lookups indexed while they are swapped, and stays in place if id_unique
+    can't be built, until the next attempt.
+    """
+    existing = await db.office_elements.index_information()
+    if "id_unique" in existing:
+        return
+    await _reassign_duplicate_element_ids(db)
+    if not {"id", "id_migration"} & set(existing):
+        # No index to swap: ensure_indexes creates id_unique
+        return
+    await db.office_elements.create_index([("id", ASCENDING), ("office_plan_id", ASCENDING)], name="id_migration")
+    if "id" in existing:
+        await db.office_elements.drop_index("id")
+    try:
+        await db.office_elements.create_index([("id", ASCENDING)], unique=True, name="id_unique")
+    except OperationFailure as exc:
+        logger.error("Could not make office_elements.id unique, keeping id_migration: %s", exc)
+        return
+    await db.office_elements.drop_index("id_migration")
+
+
+async def ensure_indexes(db):
+    """Create every registered index, then drop the legacy indexes they replace
+
+    Indexes created by hand are left alone. A legacy index is only dropped
+    once every registered index of its collection exists.
+    """
+    # Plans first: their copies are told apart by their duplicated elements
+    if "id_unique" not in await db.office_plans.index_information():
+        await _reassign_duplicate_plan_ids(db)
+    await _migrate_element_id_index(db)
+    for collection, indexes in INDEXES.items():
+        created = True
+        for index in indexes:
+            try:
+                await db[collection].create_indexes([index])
+            except OperationFailure as exc:
+                created = False
+                logger.error("Could not create index %s.%s: %s", collection, index.document["name"], exc)
+        if not created:
+            continue
+        existing = await db[collection].index_information()
+        for name in LEGACY_INDEXES.get(collection, ()):
+            if name in existing:
+                logger.info("Dropping legacy index %s.%s", collection, name)
+                await db[collection].drop_index(name)
+
+
+def _stages(plan):
+    """Yield every stage name of an explain plan tree"""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _stages(value)
+
+
+async def check_query_shapes(db):
+    """Explain every registered query shape and return the ones doing a COLLSCAN"""
+    collscans = []
+    for collection, query, sort in QUERY_SHAPES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        winning_plan = explain["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in _stages(winning_plan):
+            collscans.append((collection, query, sort))
+    return collscans
+
+
+async def _main(check: bool) -> int:
+    load_dotenv(ROOT_DIR / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        await ensure_indexes(db)
+        if not check:
+            return 0
+
+        collscans = await check_query_shapes(db)
+        for collection, query, sort in collscans:
+            sort_keys = [key for key, _ in sort] if sort else []
+            print(f"COLLSCAN {collection} filter={sorted(query)} sort={sort_keys}")
+        print(f"{len(QUERY_SHAPES) - len(collscans)}/{len(QUERY_SHAPES)} query shapes use an index")
+        return 1 if collscans else 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply MongoDB indexes")
+    parser.add_argument("--check", action="store_true", help="report query shapes that still do a COLLSCAN")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_main(args.check)))
@@ -0,0 +1,94 @@
+"""Group memberships.
+
+``group_memberships`` holds one document per (group, user) pair, unique on
+that pair, with a reverse (user_id, group_id) index so the groups of a user
+are a single indexed query. A group's ``members`` counter moves by the number
+of memberships a write actually inserted or deleted, so concurrent adds and
+removes can't make it drift or go below zero. It can't be set through the
+group routes; counts predating the collection are recomputed from it on
+startup by ``backfill_member_counts``.
+"""
+from datetime import datetime
+from typing import List, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+import counters
+from models import GroupMembership
+
+DUPLICATE_KEY = 11000
+
+
+async def group_ids(db, user_id: str) -> List[str]:
+    """Ids of the groups of a user, read from the reverse index alone"""
+    memberships = db.group_memberships.find({"user_id": user_id}, {"_id": 0, "group_id": 1})
+    return [membership["group_id"] async for membership in memberships]
+
+
+async def _count(db, group_id: str, delta: int):
+    if delta:
+        await db.groups.update_one(
+            {"id": group_id},
+            {"$inc": {"members": delta}, "$set": {"updated_at": datetime.utcnow()}}
+        )
+
+
+async def add_members(db, group_id: str, user_ids: List[str]) -> Tuple[int, List[str]]:
+    """Add users to a group, returning how many weren't members yet and the ids of unknown users"""
+    user_ids = list(dict.fromkeys(user_ids))
+    known = {user["id"] async for user in db.users.find({"id": {"$in": user_ids}}, {"_id": 0, "id": 1})}
+    memberships = [GroupMembership(group_id=group_id, user_id=user_id).dict() for user_id in user_ids if user_id in known]
+    inserted = len(memberships)
+    if memberships:
+        try:
+            await db.group_memberships.insert_many(memberships, ordered=False)
+        except BulkWriteError as exc:
+            errors = exc.details["writeErrors"]
+            if any(error["code"] != DUPLICATE_KEY for error in errors):
+                raise
+            # Already members
+            inserted -= len(errors)
+    await _count(db, group_id, inserted)
+    return inserted, [user_id for user_id in user_ids if user_id not in known]
+
+
+async def remove_members(db, group_id: str, user_ids: List[str]) -> int:
+    """Remove users from a group, returning how many were members"""
+    result = await db.group_memberships.delete_many({"group_id": group_id, "user_id": {"$in": user_ids}})
+    await _count(db, group_id, -result.deleted_count)
+    return result.deleted_count
+
+
+async def remove_user(db, user_id: str) -> List[str]:
+    """Remove a deleted user from all their groups, returning the ids of those groups"""
+    removed = []
+    for group_id in await group_ids(db, user_id):
+        # Per group, so only the memberships this call deleted are uncounted
+        if await db.group_memberships.find_one_and_delete({"user_id": user_id, "group_id": group_id}):
+            await _count(db, group_id, -1)
+            removed.append(group_id)
+    return removed
+
+
+async def remove_group(db, group_id: str):
+    """Drop the memberships of a deleted group"""
+    await db.group_memberships.delete_many({"group_id": group_id})
+
+
+async def backfill_member_counts(db):
+    """Set the members counter of every group whose value disagrees with its memberships"""
+    counts = {
+        row["_id"]: row["count"] async for row in db.group_memberships.aggregate([
+            {"$group": {"_id": "$group_id", "count": {"$sum": 1}}}
+        ])
+    }
+    updates = []
+    async for group in db.groups.find({}, {"_id": 0, "id": 1, "members": 1}):
+        count = counts.get(group["id"], 0)
+        if group.get("members") != count:
+            # Conditional, so a membership written meanwhile isn't overwritten
+            updates.append(UpdateOne({"id": group["id"], "members": group.get("members")}, {"$set": {"members": count}}))
+    if updates:
+        await db.groups.bulk_write(updates, ordered=False)
+        await counters.apply_delta(db, counters.revision_delta("groups"))
@@ -58,6 +58,11 @@ class OfficeElementStatus(str, Enum):
     RESERVED = "reserved"
     MAINTENANCE = "maintenance"
 
+class BatchOperationType(str, Enum):
+    CREATE = "create"
+    UPDATE = "update"
+    DELETE = "delete"
+
 # User Models
 class User(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -112,7 +117,23 @@ class GroupUpdate(BaseModel):
     leader: Optional[str] = None
     permissions: Optional[List[Permission]] = None
     status: Optional[GroupStatus] = None
-    members: Optional[int] = None
+
+class GroupMembership(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    group_id: str
+    user_id: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class GroupMembersUpdate(BaseModel):
+    user_ids: List[str]
+
+class GroupMembersResult(BaseModel):
+    changed: int  # Adhésions réellement créées ou supprimées
+    unknown_users: List[str] = []
+
+class EffectivePermissions(BaseModel):
+    user_id: str
+    permissions: List[Permission]  # Union des permissions des groupes actifs de l'utilisateur
 
 # Equipment Models
 class Equipment(BaseModel):
@@ -190,7 +211,43 @@ class OfficeElementUpdate(BaseModel):
     assigned_to: Optional[str] = None
     properties: Optional[Dict[str, Any]] = None
 
+class OfficeElementOperation(BaseModel):
+    op: BatchOperationType
+    id: Optional[str] = None  # Elément ciblé par update/delete
+    element: Optional[OfficeElementCreate] = None  # Requis pour create
+    changes: Optional[OfficeElementUpdate] = None  # Requis pour update
+
+class OfficeElementBatch(BaseModel):
+    operations: List[OfficeElementOperation]
+    force: bool = False  # Autorise les chevauchements
+
+class OfficeElementOperationResult(BaseModel):
+    index: int
+    op: BatchOperationType
+    id: Optional[str] = None
+    ok: bool
+    error: Optional[str] = None
+    conflicts: List[str] = []  # Eléments chevauchés
+
+class OfficeElementBatchResult(BaseModel):
+    created: int = 0
+    updated: int = 0
+    deleted: int = 0
+    results: List[OfficeElementOperationResult]
+
+class NearestDesk(BaseModel):
+    distance: float  # Distance en pixels entre l'ancre et le centre du bureau
+    element: OfficeElement
+
 # Office Plan Models
+class PlanVersion(BaseModel):
+    version: int
+    created: int = 0  # Éléments créés par cette version
+    updated: int = 0  # Éléments modifiés
+    deleted: int = 0  # Éléments supprimés
+    plan_updated: bool = False  # Propriétés du plan modifiées
+    created_at: datetime
+
 class OfficePlan(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
@@ -202,9 +259,25 @@ class OfficePlan(BaseModel):
     elements: List[OfficeElement] = []
     created_by: str
     is_active: bool = True
+    version: int = 0  # Incrémenté à chaque modification du plan ou de ses éléments
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
+class OfficePlanSummary(BaseModel):
+    id: str
+    name: str
+    description: Optional[str] = None
+    width: float
+    height: float
+    background_color: str = "#ffffff"
+    grid_size: int = 20
+    element_count: int
+    created_by: str
+    is_active: bool = True
+    version: int = 0
+    created_at: datetime
+    updated_at: datetime
+
 class OfficePlanCreate(BaseModel):
     name: str
     description: Optional[str] = None
@@ -235,4 +308,47 @@ class Statistics(BaseModel):
     total_office_plans: int
     total_office_elements: int
     available_desks: int
-    occupied_desks: int
\ No newline at end of file
+    occupied_desks: int
+
+class PlanCacheStatistics(BaseModel):
+    hits: int
+    shared_hits: int  # Trouvés dans le cache partagé entre workers
+    misses: int
+    evictions: int
+    entries: int
+    bytes: int
+    max_bytes: int
+    backend: Optional[str] = None
+
+class ImportRowError(BaseModel):
+    row: int  # Numéro de la ligne de données, la première vaut 1
+    message: str
+
+class ImportReport(BaseModel):
+    collection: str
+    received: int = 0
+    inserted: int = 0
+    failed: int = 0
+    errors: List[ImportRowError] = []  # Les MAX_REPORTED_ERRORS premières erreurs
+    elapsed_seconds: float = 0
+    rows_per_second: float = 0
+
+class PropagationJobStatus(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+class PropagationJob(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    kind: str  # "rename" ou "delete"
+    references: List[str]  # Valeurs à remplacer dans les documents qui citent l'utilisateur
+    status: PropagationJobStatus = PropagationJobStatus.PENDING
+    progress: Dict[str, int] = {}  # Documents mis à jour, par collection
+    skipped_references: List[str] = []  # Noms portés par d'autres utilisateurs, laissés tels quels
+    attempts: int = 0
+    error: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
\ No newline at end of file
@@ -0,0 +1,111 @@
+"""Effective permissions of users, cached per user.
+
+A user's permissions are the union of the ``permissions`` of their active
+groups (``GroupStatus.ACTIF``), resolved with two indexed queries: their group
+ids from the reverse membership index, then the active groups among them.
+
+Results are kept in an in-process LRU of PERMISSION_CACHE_MAX_ENTRIES users
+for PERMISSION_CACHE_TTL seconds, so a permission check on a warm user is a
+dictionary lookup. Group routes invalidate the members of a group whose
+permissions or status change, and the users added to or removed from a group.
+Each worker has its own cache: a change made through another worker is seen
+within the TTL.
+
+Routes check permissions with ``Depends(require_permission(db, Permission.WRITE))``,
+the caller being identified by the ``X-User-Id`` header.
+"""
+import os
+import time
+from collections import OrderedDict
+from typing import FrozenSet, Iterable, Optional, Tuple
+
+from fastapi import Header, HTTPException
+
+import memberships
+from models import GroupStatus, Permission
+
+DEFAULT_TTL = 60
+DEFAULT_MAX_ENTRIES = 10000
+
+USER_ID_HEADER = "X-User-Id"
+
+
+class PermissionCache:
+    def __init__(self, ttl: float = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, FrozenSet[Permission]]]" = OrderedDict()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, user_id: str) -> Optional[FrozenSet[Permission]]:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, user_id: str, permissions: FrozenSet[Permission], generation: int):
+        """Store permissions if no invalidation happened since generation was read"""
+        if generation != self._generation:
+            return
+        self._entries[user_id] = (time.monotonic() + self.ttl, permissions)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_ids: Iterable[str]):
+        for user_id in user_ids:
+            self._entries.pop(user_id, None)
+        self._generation += 1
+
+
+permission_cache = PermissionCache(
+    ttl=float(os.environ.get("PERMISSION_CACHE_TTL", DEFAULT_TTL)),
+    max_entries=int(os.environ.get("PERMISSION_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+)
+
+
+async def effective_permissions(db, user_id: str) -> FrozenSet[Permission]:
+    """Union of the permissions of the user's active groups"""
+    cached = permission_cache.get(user_id)
+    if cached is not None:
+        return cached
+    generation = permission_cache.generation
+    group_ids = await memberships.group_ids(db, user_id)
+    permissions = set()
+    if group_ids:
+        async for group in db.groups.find(
+            {"id": {"$in": group_ids}, "status": GroupStatus.ACTIF}, {"_id": 0, "permissions": 1}
+        ):
+            permissions.update(Permission(permission) for permission in group.get("permissions", []))
+    permissions = frozenset(permissions)
+    permission_cache.set(user_id, permissions, generation)
+    return permissions
+
+
+async def invalidate_group(db, group_id: str):
+    """Drop the cached permissions of the members of a group"""
+    permission_cache.invalidate([
+        membership["user_id"] async for membership in
+        db.group_memberships.find({"group_id": group_id}, {"_id": 0, "user_id": 1})
+    ])
+
+
+def require_permission(db, permission: Permission):
+    """FastAPI dependency rejecting callers without permission, returning their permissions"""
+    async def dependency(x_user_id: str = Header(..., alias=USER_ID_HEADER)) -> FrozenSet[Permission]:
+        permissions = await effective_permissions(db, x_user_id)
+        if permission not in permissions:
+            raise HTTPException(status_code=403, detail=f"Permission '{permission.value}' required")
+        return permissions
+    return dependency
@@ -0,0 +1,183 @@
+"""Read-through cache of serialized plan responses.
+
+``GET /office-plans/{id}`` responses are kept as the exact bytes sent, keyed
+by plan id and version. The route already reads the plan's version to tag the
+response, so a cached body is only ever served for the version it was built
+from and a write can't make it stale; write routes still invalidate the plan
+to free its entry right away.
+
+The in-process level is an LRU bounded by PLAN_CACHE_MAX_BYTES, holding one
+version per plan. Behind it an optional shared backend, chosen with
+PLAN_CACHE_BACKEND, lets every uvicorn worker reuse a body serialized by
+another one:
+
+- ``none`` (default): in-process level only;
+- ``memory``: in-process stand-in for a shared backend, for a single worker;
+- ``mongo``: the ``plan_cache`` collection.
+"""
+import logging
+import os
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from bson import Binary
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Bodies larger than this fraction of the cache are streamed without being kept
+MAX_ENTRY_FRACTION = 4
+# Below the 16 MB document limit
+MAX_SHARED_ENTRY_BYTES = 15 * 1024 * 1024
+
+
+class CacheBackend(ABC):
+    """Shared level of the plan cache"""
+
+    @abstractmethod
+    async def get(self, plan_id: str, version: int) -> Optional[bytes]:
+        """The body cached for this version of the plan, None if there is none"""
+
+    @abstractmethod
+    async def set(self, plan_id: str, version: int, body: bytes):
+        """Cache body for this version of the plan, unless a newer one is cached"""
+
+    @abstractmethod
+    async def delete(self, plan_id: str):
+        """Drop the body cached for the plan"""
+
+
+class MemoryBackend(CacheBackend):
+    def __init__(self):
+        self._entries: Dict[str, Tuple[int, bytes]] = {}
+
+    async def get(self, plan_id: str, version: int) -> Optional[bytes]:
+        entry = self._entries.get(plan_id)
+        return entry[1] if entry and entry[0] == version else None
+
+    async def set(self, plan_id: str, version: int, body: bytes):
+        entry = self._entries.get(plan_id)
+        if entry is None or entry[0] < version:
+            self._entries[plan_id] = (version, body)
+
+    async def delete(self, plan_id: str):
+        self._entries.pop(plan_id, None)
+
+
+class MongoBackend(CacheBackend):
+    def __init__(self, db):
+        self.collection = db.plan_cache
+
+    async def get(self, plan_id: str, version: int) -> Optional[bytes]:
+        entry = await self.collection.find_one({"_id": plan_id, "version": version}, {"body": 1})
+        return bytes(entry["body"]) if entry else None
+
+    async def set(self, plan_id: str, version: int, body: bytes):
+        if len(body) > MAX_SHARED_ENTRY_BYTES:
+            return
+        try:
+            # Never replace a newer version stored by another worker
+            await self.collection.update_one(
+                {"_id": plan_id, "version": {"$lt": version}},
+                {"$set": {"version": version, "body": Binary(body)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            pass
+
+    async def delete(self, plan_id: str):
+        await self.collection.delete_one({"_id": plan_id})
+
+
+class PlanCache:
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, backend: Optional[CacheBackend] = None):
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self._entries: "OrderedDict[str, Tuple[int, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _store(self, plan_id: str, version: int, body: bytes):
+        if len(body) > self.max_bytes // MAX_ENTRY_FRACTION:
+            return
+        self._drop(plan_id)
+        self._entries[plan_id] = (version, body)
+        self._bytes += len(body)
+        while self._bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    def _drop(self, plan_id: str):
+        entry = self._entries.pop(plan_id, None)
+        if entry:
+            self._bytes -= len(entry[1])
+
+    async def get(self, plan_id: str, version: int) -> Optional[bytes]:
+        entry = self._entries.get(plan_id)
+        if entry and entry[0] == version:
+            self._entries.move_to_end(plan_id)
+            self.hits += 1
+            return entry[1]
+        if self.backend:
+            body = await self.backend.get(plan_id, version)
+            if body is not None:
+                self._store(plan_id, version, body)
+                self.shared_hits += 1
+                return body
+        self.misses += 1
+        return None
+
+    async def set(self, plan_id: str, version: int, body: bytes):
+        self._store(plan_id, version, body)
+        if self.backend:
+            await self.backend.set(plan_id, version, body)
+
+    async def capture(self, plan_id: str, version: int, parts: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """Pass a streamed body through, storing it once complete unless it outgrows the cache"""
+        limit = self.max_bytes // MAX_ENTRY_FRACTION
+        body = bytearray()
+        async for part in parts:
+            if body is not None:
+                body += part
+                if len(body) > limit:
+                    body = None
+            yield part
+        if body is not None:
+            await self.set(plan_id, version, bytes(body))
+
+    async def invalidate(self, plan_id: str):
+        self._drop(plan_id)
+        if self.backend:
+            await self.backend.delete(plan_id)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "backend": type(self.backend).__name__ if self.backend else None,
+        }
+
+    def configure(self, db):
+        """Apply PLAN_CACHE_MAX_BYTES and PLAN_CACHE_BACKEND"""
+        self.max_bytes = int(os.environ.get("PLAN_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+        backend = os.environ.get("PLAN_CACHE_BACKEND", "none")
+        if backend == "memory":
+            self.backend = MemoryBackend()
+        elif backend == "mongo":
+            self.backend = MongoBackend(db)
+        elif backend != "none":
+            logger.error("Unknown PLAN_CACHE_BACKEND %s, using the in-process cache only", backend)
+
+
+plan_cache = PlanCache()
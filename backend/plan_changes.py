@@ -0,0 +1,36 @@
+"""Bookkeeping shared by every write to a plan or its elements.
+
+A write bumps the plan's ``version``, then its operations are logged: they
+are appended to the plan's history, the cached plan bodies are dropped and
+the operations are published to the change feed, with the new version as
+sequence number.
+"""
+from datetime import datetime
+from typing import List, Optional
+
+from pymongo import ReturnDocument
+
+import plan_history
+from plan_cache import plan_cache
+from plan_feed import plan_feed
+
+
+async def log_changes(db, plan_id: str, version: int, ops: List[Optional[dict]]):
+    """Append the operations that produced version to the plan's history and publish them"""
+    ops = [op for op in ops if op]
+    # Logged first: the history must not miss a version that is served or published
+    await plan_history.record(db, plan_id, version, ops)
+    await plan_cache.invalidate(plan_id)
+    await plan_feed.publish(db, plan_id, version, ops)
+
+
+async def plan_changed(db, plan_id: str, ops: List[Optional[dict]]):
+    """Bump the plan's version and updated_at, then log the element operations applied to it"""
+    plan = await db.office_plans.find_one_and_update(
+        {"id": plan_id},
+        {"$set": {"updated_at": datetime.utcnow()}, "$inc": {"version": 1}},
+        projection={"_id": 0, "version": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if plan:
+        await log_changes(db, plan_id, plan["version"], ops)
@@ -0,0 +1,134 @@
+"""Per-plan change feed pushed to WebSocket subscribers.
+
+Element write routes bump the plan's ``version`` and publish one message per
+write, with that version as sequence number and the element-level operations
+it applied:
+
+    {"type": "delta", "plan_id": ..., "seq": 12, "ops": [
+        {"op": "create", "id": ..., "element": {...}},
+        {"op": "update", "id": ..., "changes": {"x": 120}},
+        {"op": "delete", "id": ...}
+    ]}
+
+Operations are idempotent (create is an upsert by id), so a client may safely
+receive a delta already reflected in its snapshot.
+
+With a single worker, messages are fanned out in process and the last
+HISTORY_SIZE messages of each plan are kept to resume late joiners. When
+MongoDB runs as a replica set, messages are instead inserted in the
+``plan_changes`` collection and every worker tails it through a change
+stream, so all workers see all writes and can resume from the collection.
+"""
+import asyncio
+import logging
+from collections import defaultdict, deque
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from fastapi.encoders import jsonable_encoder
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+HISTORY_SIZE = 500
+QUEUE_SIZE = 1000
+# Resume window of the shared plan_changes collection
+CHANGES_TTL_SECONDS = 24 * 3600
+WATCH_RETRY_SECONDS = 5
+
+
+class PlanFeed:
+    def __init__(self):
+        self.subscribers: Dict[str, set] = defaultdict(set)
+        self.history: Dict[str, deque] = defaultdict(lambda: deque(maxlen=HISTORY_SIZE))
+        self.shared = False
+        self._watcher: Optional[asyncio.Task] = None
+
+    def subscribe(self, plan_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.subscribers[plan_id].add(queue)
+        return queue
+
+    def unsubscribe(self, plan_id: str, queue: asyncio.Queue):
+        self.subscribers[plan_id].discard(queue)
+        if not self.subscribers[plan_id]:
+            del self.subscribers[plan_id]
+
+    def _deliver(self, message: dict):
+        plan_id = message["plan_id"]
+        if not self.shared:
+            self.history[plan_id].append(message)
+        for queue in list(self.subscribers.get(plan_id, ())):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # The subscriber can't keep up: it gets None and resumes later
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    async def publish(self, db, plan_id: str, seq: int, ops: List[dict]):
+        """Publish the operations a write applied to a plan, seq being the plan's new version"""
+        if not ops:
+            return
+        message = jsonable_encoder({"type": "delta", "plan_id": plan_id, "seq": seq, "ops": ops})
+        if self.shared:
+            await db.plan_changes.insert_one({**message, "created_at": datetime.utcnow()})
+        else:
+            self._deliver(message)
+
+    async def missed(self, db, plan_id: str, since: int, current: int) -> Optional[List[dict]]:
+        """Messages published after seq since, None if some of them are no longer available
+
+        A since ahead of the plan's current version can't be resumed from either.
+        """
+        if since == current:
+            return []
+        if since > current:
+            return None
+        if self.shared:
+            messages = await db.plan_changes.find(
+                {"plan_id": plan_id, "seq": {"$gt": since}},
+                {"_id": 0, "created_at": 0}
+            ).sort("seq", 1).to_list(None)
+        else:
+            messages = sorted(
+                (message for message in self.history.get(plan_id, ()) if message["seq"] > since),
+                key=lambda message: message["seq"]
+            )
+        if [message["seq"] for message in messages] != list(range(since + 1, since + 1 + len(messages))):
+            return None
+        if not messages or messages[-1]["seq"] < current:
+            return None
+        return messages
+
+    async def start(self, db):
+        """Switch to the change stream source when MongoDB runs as a replica set"""
+        hello = await db.client.admin.command("hello")
+        if "setName" not in hello:
+            return
+        self.shared = True
+        await db.plan_changes.create_index("created_at", expireAfterSeconds=CHANGES_TTL_SECONDS)
+        await db.plan_changes.create_index([("plan_id", 1), ("seq", 1)])
+        self._watcher = asyncio.create_task(self._watch(db))
+        logger.info("Plan change feed reading from the plan_changes change stream")
+
+    async def stop(self):
+        if self._watcher:
+            self._watcher.cancel()
+
+    async def _watch(self, db):
+        while True:
+            try:
+                async with db.plan_changes.watch([{"$match": {"operationType": "insert"}}]) as stream:
+                    async for change in stream:
+                        message = change["fullDocument"]
+                        message.pop("_id", None)
+                        message.pop("created_at", None)
+                        self._deliver(message)
+            except PyMongoError as exc:
+                logger.error("Plan change stream interrupted: %s", exc)
+                await asyncio.sleep(WATCH_RETRY_SECONDS)
+
+
+plan_feed = PlanFeed()
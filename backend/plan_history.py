@@ -0,0 +1,173 @@
+"""Version history of office plans.
+
+Every write to a plan or its elements is appended to ``plan_operations`` under
+the plan version it produced, with the operations it applied (the same ones
+the change feed publishes). ``plan_snapshots`` holds the full state of a plan
+at some versions: on creation, and then every SNAPSHOT_INTERVAL versions, each
+compacted from the previous snapshot and the operations logged since.
+
+Reconstructing a version loads the closest snapshot at or before it and
+replays at most SNAPSHOT_INTERVAL operations, whatever the length of the
+history. Plans created before history existed get a snapshot of their state
+at startup; their earlier versions are not available.
+"""
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from models import OfficeElement, OfficePlan
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_INTERVAL = 50
+SNAPSHOT_ATTEMPTS = 3
+
+
+def summarize(ops: List[dict]) -> dict:
+    """Number of elements created, updated and deleted by ops"""
+    kinds = [op["op"] for op in ops]
+    return {
+        "created": kinds.count("create"),
+        "updated": kinds.count("update"),
+        "deleted": kinds.count("delete"),
+        "plan_updated": "plan" in kinds,
+    }
+
+
+def apply_ops(plan: dict, elements: Dict[str, dict], ops: List[dict]):
+    """Apply logged operations to a plan and its elements by id, in place"""
+    for op in ops:
+        if op["op"] == "plan":
+            plan.update(op["changes"])
+        elif op["op"] == "create":
+            elements[op["id"]] = dict(op["element"])
+        elif op["op"] == "update":
+            if op["id"] in elements:
+                elements[op["id"]].update(op["changes"])
+        elif op["op"] == "delete":
+            elements.pop(op["id"], None)
+
+
+async def record(db, plan_id: str, version: int, ops: List[dict]):
+    """Log the operations that produced version of a plan
+
+    Versions whose write changed nothing are logged too, so the log has no
+    gaps. When the previous version was never logged, as after a write that
+    failed between bumping the version and logging it, the current state is
+    snapshotted so the versions from there on can be reconstructed.
+    """
+    await db.plan_operations.insert_one({
+        "plan_id": plan_id,
+        "version": version,
+        "ops": ops,
+        "summary": summarize(ops),
+        "created_at": datetime.utcnow()
+    })
+    if not await _logged(db, plan_id, version - 1):
+        logger.warning("Version %d of plan %s was never logged, snapshotting its current state", version - 1, plan_id)
+        await _snapshot_current(db, plan_id)
+    elif version % SNAPSHOT_INTERVAL == 0:
+        await reconstruct(db, plan_id, version)
+
+
+async def _logged(db, plan_id: str, version: int) -> bool:
+    """Whether version of a plan can be reconstructed from its own log entry or snapshot"""
+    query = {"plan_id": plan_id, "version": version}
+    return (
+        await db.plan_operations.find_one(query, {"_id": 1}) is not None
+        or await db.plan_snapshots.find_one(query, {"_id": 1}) is not None
+    )
+
+
+async def _snapshot_current(db, plan_id: str):
+    """Snapshot the current state of a plan, read again if a write bumped its version meanwhile"""
+    for _ in range(SNAPSHOT_ATTEMPTS):
+        plan = await db.office_plans.find_one({"id": plan_id}, {"_id": 0, "search_fields": 0, "search_terms": 0})
+        if not plan:
+            return
+        elements = await db.office_elements.find({"office_plan_id": plan_id}).to_list(None)
+        current = await db.office_plans.find_one({"id": plan_id}, {"_id": 0, "version": 1})
+        if current and current.get("version", 0) == plan.get("version", 0):
+            await _store_snapshot(db, plan_id, plan.get("version", 0), plan, elements)
+            return
+
+
+async def _store_snapshot(db, plan_id: str, version: int, plan: dict, elements: List[dict]):
+    await db.plan_snapshots.update_one(
+        {"plan_id": plan_id, "version": version},
+        {"$setOnInsert": {
+            "plan": OfficePlan(**plan).dict(exclude={"elements", "version"}),
+            "elements": [OfficeElement(**element).dict() for element in elements],
+            "created_at": datetime.utcnow()
+        }},
+        upsert=True
+    )
+
+
+async def snapshot(db, plan: dict):
+    """Store the current state of a plan as the snapshot of its current version
+
+    Only used while nothing else writes to the plan: on creation and at startup.
+    """
+    elements = await db.office_elements.find({"office_plan_id": plan["id"]}).to_list(None)
+    await _store_snapshot(db, plan["id"], plan.get("version", 0), plan, elements)
+
+
+async def reconstruct(db, plan_id: str, version: int) -> Optional[Tuple[dict, List[dict]]]:
+    """The plan and its elements as they were at version, None if that version is not available
+
+    When SNAPSHOT_INTERVAL operations or more had to be replayed, the result
+    is stored as a new snapshot.
+    """
+    base = await db.plan_snapshots.find_one(
+        {"plan_id": plan_id, "version": {"$lte": version}},
+        sort=[("version", -1)]
+    )
+    if not base:
+        return None
+    entries = await db.plan_operations.find(
+        {"plan_id": plan_id, "version": {"$gt": base["version"], "$lte": version}},
+        {"_id": 0, "version": 1, "ops": 1}
+    ).sort("version", 1).to_list(None)
+    if [entry["version"] for entry in entries] != list(range(base["version"] + 1, version + 1)):
+        # A write bumped the version without logging it (yet)
+        return None
+
+    plan = dict(base["plan"])
+    elements = {element["id"]: element for element in base["elements"]}
+    for entry in entries:
+        apply_ops(plan, elements, entry["ops"])
+    plan["version"] = version
+
+    state = list(elements.values())
+    if len(entries) >= SNAPSHOT_INTERVAL:
+        await _store_snapshot(db, plan_id, version, plan, state)
+    return plan, state
+
+
+async def versions(db, plan_id: str, limit: int, before: Optional[int] = None) -> List[dict]:
+    """Logged versions of a plan, newest first"""
+    query = {"plan_id": plan_id}
+    if before is not None:
+        query["version"] = {"$lt": before}
+    entries = await db.plan_operations.find(
+        query, {"_id": 0, "version": 1, "summary": 1, "created_at": 1}
+    ).sort("version", -1).limit(limit).to_list(limit)
+    return [{"version": entry["version"], "created_at": entry["created_at"], **entry["summary"]} for entry in entries]
+
+
+async def delete_history(db, plan_id: str):
+    await db.plan_operations.delete_many({"plan_id": plan_id})
+    await db.plan_snapshots.delete_many({"plan_id": plan_id})
+
+
+async def backfill_plan_snapshots(db):
+    """Snapshot the plans that have no history yet, at their current version"""
+    tracked = set(await db.plan_snapshots.distinct("plan_id"))
+    count = 0
+    async for plan in db.office_plans.find({}, {"_id": 0, "search_fields": 0, "search_terms": 0}):
+        if plan["id"] not in tracked:
+            await snapshot(db, plan)
+            count += 1
+    if count:
+        logger.info("Snapshotted %d office plans without history", count)
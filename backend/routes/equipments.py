@@ -1,44 +1,78 @@
-from fastapi import APIRouter, HTTPException
-from typing import List, Optional
-from models import Equipment, EquipmentCreate, EquipmentUpdate
+from fastapi import APIRouter, File, HTTPException, Query, Request, Response, UploadFile
+from typing import List, Literal, Optional
+from models import Equipment, EquipmentCreate, EquipmentUpdate, ImportReport
 from datetime import datetime
+from pagination import MAX_PAGE_SIZE, fetch_page
+from search import search_page, search_update, with_search_terms
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import etags
+from exports import export_response, with_search
+from imports import detect_format, import_rows, read_rows
+from serialization import TrustedJSONResponse, parse_fields, project, projection
+from user_loader import UserLoader, parse_expand
 import os
 
 router = APIRouter()
 
+# User references that expand= can embed, see user_loader.py
+EXPANDABLE = ("assigned_to",)
+
 # MongoDB connection
 from server import db
+from routes.statistics import record_change, statistics_cache
+
+def _equipment_query(type: Optional[str], status: Optional[str], assigned_to: Optional[str]) -> dict:
+    """Filters shared by the list and export routes"""
+    query = {}
+    if type:
+        query["type"] = type
+    if status:
+        query["status"] = status
+    if assigned_to:
+        query["assigned_to"] = assigned_to
+    return query
 
 @router.get("/", response_model=List[Equipment])
 async def get_equipments(
-    skip: int = 0,
-    limit: int = 100,
+    request: Request,
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     search: Optional[str] = None,
     type: Optional[str] = None,
     status: Optional[str] = None,
-    assigned_to: Optional[str] = None
+    assigned_to: Optional[str] = None,
+    fields: Optional[str] = None,
+    expand: Optional[str] = None
 ):
-    """Get all equipments with optional filtering"""
-    query = {}
+    """Get all equipments with optional filtering
     
-    # Build search query
-    if search:
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"type": {"$regex": search, "$options": "i"}},
-            {"serial_number": {"$regex": search, "$options": "i"}},
-            {"assigned_to": {"$regex": search, "$options": "i"}}
-        ]
+    fields=id,name,... restricts the returned fields.
+    expand=assigned_to embeds the assigned user as assigned_to_user.
+    """
+    names = parse_fields(fields, Equipment)
+    expanded = parse_expand(expand, EXPANDABLE)
+    query = _equipment_query(type, status, assigned_to)
     
-    if type:
-        query["type"] = type
-    if status:
-        query["status"] = status
-    if assigned_to:
-        query["assigned_to"] = assigned_to
+    not_modified = etags.check(
+        request, response, await etags.list_etag(db, request, "equipments", *(["users"] if expanded else []))
+    )
+    if not_modified:
+        return not_modified
     
-    equipments = await db.equipments.find(query).skip(skip).limit(limit).to_list(limit)
-    return [Equipment(**equipment) for equipment in equipments]
+    if search:
+        equipments = await search_page(
+            db.equipments, query, search, skip=skip, limit=limit, cursor=cursor, projection=projection(names, *expanded)
+        )
+    else:
+        equipments = await fetch_page(
+            db.equipments, query, response, skip=skip, limit=limit, cursor=cursor, projection=projection(names, *expanded)
+        )
+    results = [project(equipment, Equipment, names) for equipment in equipments]
+    await UserLoader(db).expand(equipments, expanded, results)
+    return TrustedJSONResponse(results, headers=response.headers)
 
 @router.post("/", response_model=Equipment)
 async def create_equipment(equipment_data: EquipmentCreate):
@@ -51,83 +85,134 @@ async def create_equipment(equipment_data: EquipmentCreate):
     equipment_dict = equipment_data.dict()
     equipment = Equipment(**equipment_dict)
     
-    await db.equipments.insert_one(equipment.dict())
+    try:
+        await db.equipments.insert_one(with_search_terms("equipments", equipment.dict()))
+    except DuplicateKeyError:
+        # Created meanwhile, caught by the unique serial number index
+        raise HTTPException(status_code=400, detail="Serial number already exists")
+    await record_change("equipments", after=equipment.dict())
     return equipment
 
+@router.post("/import", response_model=ImportReport)
+async def import_equipments(file: UploadFile = File(...), format: Optional[Literal["csv", "json"]] = None):
+    """Create equipment in bulk from a CSV or JSON file, see imports.py
+    
+    Rows failing validation or duplicating an existing serial number are reported and skipped.
+    """
+    report = await import_rows(db, "equipments", read_rows(file.file, format or detect_format(file.filename)))
+    statistics_cache.invalidate()
+    return report
+
+@router.get("/export")
+async def export_equipments(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    since: Optional[datetime] = None,
+    search: Optional[str] = None,
+    type: Optional[str] = None,
+    status: Optional[str] = None,
+    assigned_to: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """Stream every equipment matching the list filters as NDJSON or CSV
+
+    since=<updated_at> only exports the equipments updated since then, see exports.py.
+    """
+    query = with_search(_equipment_query(type, status, assigned_to), search)
+    return export_response(db.equipments, query, Equipment, format, "equipments", since, parse_fields(fields, Equipment))
+
 @router.get("/{equipment_id}", response_model=Equipment)
-async def get_equipment(equipment_id: str):
+async def get_equipment(
+    equipment_id: str, request: Request, response: Response, fields: Optional[str] = None, expand: Optional[str] = None
+):
     """Get a specific equipment by ID"""
-    equipment = await db.equipments.find_one({"id": equipment_id})
+    names = parse_fields(fields, Equipment)
+    expanded = parse_expand(expand, EXPANDABLE)
+    equipment = await db.equipments.find_one(
+        {"id": equipment_id}, projection(names, "id", *etags.TAGGED_FIELDS["equipments"], *expanded)
+    )
     if not equipment:
         raise HTTPException(status_code=404, detail="Equipment not found")
-    return Equipment(**equipment)
+    etag = etags.document_etag("equipments", equipment, request)
+    if expanded:
+        etag = await etags.with_revisions(db, etag, "users")
+    not_modified = etags.check(request, response, etag)
+    if not_modified:
+        return not_modified
+    result = project(equipment, Equipment, names)
+    await UserLoader(db).expand([equipment], expanded, [result])
+    return TrustedJSONResponse(result, headers=response.headers)
 
 @router.put("/{equipment_id}", response_model=Equipment)
 async def update_equipment(equipment_id: str, equipment_data: EquipmentUpdate):
     """Update an equipment"""
-    equipment = await db.equipments.find_one({"id": equipment_id})
-    if not equipment:
-        raise HTTPException(status_code=404, detail="Equipment not found")
-    
     update_data = {k: v for k, v in equipment_data.dict().items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
     
-    await db.equipments.update_one({"id": equipment_id}, {"$set": update_data})
+    try:
+        equipment = await db.equipments.find_one_and_update(
+            {"id": equipment_id},
+            search_update("equipments", update_data),
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Serial number already exists")
+    if not equipment:
+        raise HTTPException(status_code=404, detail="Equipment not found")
     
-    updated_equipment = await db.equipments.find_one({"id": equipment_id})
+    updated_equipment = {**equipment, **update_data}
+    await record_change("equipments", before=equipment, after=updated_equipment)
     return Equipment(**updated_equipment)
 
 @router.delete("/{equipment_id}")
 async def delete_equipment(equipment_id: str):
     """Delete an equipment"""
-    result = await db.equipments.delete_one({"id": equipment_id})
-    if result.deleted_count == 0:
+    equipment = await db.equipments.find_one_and_delete({"id": equipment_id})
+    if not equipment:
         raise HTTPException(status_code=404, detail="Equipment not found")
+    await record_change("equipments", before=equipment)
     return {"message": "Equipment deleted successfully"}
 
 @router.put("/{equipment_id}/assign/{user_id}")
 async def assign_equipment(equipment_id: str, user_id: str):
     """Assign equipment to a user"""
-    equipment = await db.equipments.find_one({"id": equipment_id})
-    if not equipment:
-        raise HTTPException(status_code=404, detail="Equipment not found")
-    
     # Check if user exists
-    user = await db.users.find_one({"id": user_id})
+    user = await db.users.find_one({"id": user_id}, {"name": 1})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Update equipment assignment and status
-    await db.equipments.update_one(
-        {"id": equipment_id}, 
-        {
-            "$set": {
-                "assigned_to": user["name"],
-                "status": "En service",
-                "updated_at": datetime.utcnow()
-            }
-        }
+    update_data = {
+        "assigned_to": user["name"],
+        "status": "En service",
+        "updated_at": datetime.utcnow()
+    }
+    equipment = await db.equipments.find_one_and_update(
+        {"id": equipment_id},
+        search_update("equipments", update_data),
+        return_document=ReturnDocument.BEFORE
     )
+    if not equipment:
+        raise HTTPException(status_code=404, detail="Equipment not found")
+    await record_change("equipments", before=equipment, after={**equipment, **update_data})
     
     return {"message": "Equipment assigned successfully"}
 
 @router.put("/{equipment_id}/unassign")
 async def unassign_equipment(equipment_id: str):
     """Unassign equipment from user"""
-    equipment = await db.equipments.find_one({"id": equipment_id})
-    if not equipment:
-        raise HTTPException(status_code=404, detail="Equipment not found")
-    
     # Update equipment to remove assignment
-    await db.equipments.update_one(
-        {"id": equipment_id}, 
-        {
-            "$set": {
-                "assigned_to": None,
-                "status": "Disponible",
-                "updated_at": datetime.utcnow()
-            }
-        }
+    update_data = {
+        "assigned_to": None,
+        "status": "Disponible",
+        "updated_at": datetime.utcnow()
+    }
+    equipment = await db.equipments.find_one_and_update(
+        {"id": equipment_id},
+        search_update("equipments", update_data),
+        return_document=ReturnDocument.BEFORE
     )
+    if not equipment:
+        raise HTTPException(status_code=404, detail="Equipment not found")
+    await record_change("equipments", before=equipment, after={**equipment, **update_data})
     
-    return {"message": "Equipment unassigned successfully"}
\ No newline at end of file
+    return {"message": "Equipment unassigned successfully"}
@@ -1,37 +1,73 @@
-from fastapi import APIRouter, HTTPException
-from typing import List, Optional
-from models import Group, GroupCreate, GroupUpdate
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from typing import List, Literal, Optional
+from models import Group, GroupCreate, GroupUpdate, GroupMembersUpdate, GroupMembersResult, User
 from datetime import datetime
+from pagination import MAX_PAGE_SIZE, fetch_page
+from search import search_page, search_update, with_search_terms
+from pymongo import ReturnDocument
+import etags
+from exports import export_response, with_search
+from serialization import TrustedJSONResponse, parse_fields, project, projection
+from user_loader import UserLoader, parse_expand
+import memberships
+from permissions import invalidate_group, permission_cache
 import os
 
 router = APIRouter()
 
+# User references that expand= can embed, see user_loader.py
+EXPANDABLE = ("leader",)
+
 # MongoDB connection
 from server import db
+from routes.statistics import record_change, record_delta
+import counters
+
+def _group_query(status: Optional[str]) -> dict:
+    """Filters shared by the list and export routes"""
+    query = {}
+    if status:
+        query["status"] = status
+    return query
 
 @router.get("/", response_model=List[Group])
 async def get_groups(
-    skip: int = 0,
-    limit: int = 100,
+    request: Request,
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     search: Optional[str] = None,
-    status: Optional[str] = None
+    status: Optional[str] = None,
+    fields: Optional[str] = None,
+    expand: Optional[str] = None
 ):
-    """Get all groups with optional filtering"""
-    query = {}
+    """Get all groups with optional filtering
     
-    # Build search query
-    if search:
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}},
-            {"leader": {"$regex": search, "$options": "i"}}
-        ]
+    fields=id,name,... restricts the returned fields.
+    expand=leader embeds the leader's user as leader_user.
+    """
+    names = parse_fields(fields, Group)
+    expanded = parse_expand(expand, EXPANDABLE)
+    query = _group_query(status)
     
-    if status:
-        query["status"] = status
+    not_modified = etags.check(
+        request, response, await etags.list_etag(db, request, "groups", *(["users"] if expanded else []))
+    )
+    if not_modified:
+        return not_modified
     
-    groups = await db.groups.find(query).skip(skip).limit(limit).to_list(limit)
-    return [Group(**group) for group in groups]
+    if search:
+        groups = await search_page(
+            db.groups, query, search, skip=skip, limit=limit, cursor=cursor, projection=projection(names, *expanded)
+        )
+    else:
+        groups = await fetch_page(
+            db.groups, query, response, skip=skip, limit=limit, cursor=cursor, projection=projection(names, *expanded)
+        )
+    results = [project(group, Group, names) for group in groups]
+    await UserLoader(db).expand(groups, expanded, results)
+    return TrustedJSONResponse(results, headers=response.headers)
 
 @router.post("/", response_model=Group)
 async def create_group(group_data: GroupCreate):
@@ -44,73 +80,152 @@ async def create_group(group_data: GroupCreate):
     group_dict = group_data.dict()
     group = Group(**group_dict)
     
-    await db.groups.insert_one(group.dict())
+    await db.groups.insert_one(with_search_terms("groups", group.dict()))
+    await record_change("groups", after=group.dict())
     return group
 
+@router.get("/export")
+async def export_groups(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    since: Optional[datetime] = None,
+    search: Optional[str] = None,
+    status: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """Stream every group matching the list filters as NDJSON or CSV
+
+    since=<updated_at> only exports the groups updated since then, see exports.py.
+    """
+    query = with_search(_group_query(status), search)
+    return export_response(db.groups, query, Group, format, "groups", since, parse_fields(fields, Group))
+
 @router.get("/{group_id}", response_model=Group)
-async def get_group(group_id: str):
+async def get_group(
+    group_id: str, request: Request, response: Response, fields: Optional[str] = None, expand: Optional[str] = None
+):
     """Get a specific group by ID"""
-    group = await db.groups.find_one({"id": group_id})
+    names = parse_fields(fields, Group)
+    expanded = parse_expand(expand, EXPANDABLE)
+    group = await db.groups.find_one({"id": group_id}, projection(names, "id", *etags.TAGGED_FIELDS["groups"], *expanded))
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
-    return Group(**group)
+    etag = etags.document_etag("groups", group, request)
+    if expanded:
+        etag = await etags.with_revisions(db, etag, "users")
+    not_modified = etags.check(request, response, etag)
+    if not_modified:
+        return not_modified
+    result = project(group, Group, names)
+    await UserLoader(db).expand([group], expanded, [result])
+    return TrustedJSONResponse(result, headers=response.headers)
 
 @router.put("/{group_id}", response_model=Group)
 async def update_group(group_id: str, group_data: GroupUpdate):
     """Update a group"""
-    group = await db.groups.find_one({"id": group_id})
-    if not group:
-        raise HTTPException(status_code=404, detail="Group not found")
-    
     update_data = {k: v for k, v in group_data.dict().items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
     
-    await db.groups.update_one({"id": group_id}, {"$set": update_data})
+    group = await db.groups.find_one_and_update(
+        {"id": group_id},
+        search_update("groups", update_data),
+        return_document=ReturnDocument.BEFORE
+    )
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
     
-    updated_group = await db.groups.find_one({"id": group_id})
+    updated_group = {**group, **update_data}
+    await record_change("groups", before=group, after=updated_group)
+    if "permissions" in update_data or "status" in update_data:
+        await invalidate_group(db, group_id)
     return Group(**updated_group)
 
 @router.delete("/{group_id}")
 async def delete_group(group_id: str):
     """Delete a group"""
-    result = await db.groups.delete_one({"id": group_id})
-    if result.deleted_count == 0:
+    group = await db.groups.find_one_and_delete({"id": group_id})
+    if not group:
         raise HTTPException(status_code=404, detail="Group not found")
+    await record_change("groups", before=group)
+    await invalidate_group(db, group_id)
+    await memberships.remove_group(db, group_id)
+    await record_delta(counters.revision_delta("group_memberships"))
     return {"message": "Group deleted successfully"}
 
+async def _membership_changed(changed: int, user_ids: List[str]):
+    if changed:
+        await record_delta(counters.revision_delta("groups", "group_memberships"))
+        permission_cache.invalidate(user_ids)
+
+@router.get("/{group_id}/members", response_model=List[User])
+async def get_group_members(
+    group_id: str,
+    request: Request,
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    """Get the members of a group, in the order they joined"""
+    group = await db.groups.find_one({"id": group_id}, {"_id": 1})
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    
+    not_modified = etags.check(request, response, await etags.list_etag(db, request, "group_memberships", "users"))
+    if not_modified:
+        return not_modified
+    
+    page = await fetch_page(db.group_memberships, {"group_id": group_id}, response, skip=skip, limit=limit, cursor=cursor)
+    users = {user["id"]: user async for user in db.users.find({"id": {"$in": [m["user_id"] for m in page]}})}
+    return TrustedJSONResponse(
+        [project(users[m["user_id"]], User) for m in page if m["user_id"] in users], headers=response.headers
+    )
+
+@router.post("/{group_id}/members", response_model=GroupMembersResult)
+async def add_members_to_group(group_id: str, data: GroupMembersUpdate):
+    """Add users to a group, unknown users and existing members are skipped"""
+    group = await db.groups.find_one({"id": group_id}, {"_id": 1})
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    added, unknown = await memberships.add_members(db, group_id, data.user_ids)
+    await _membership_changed(added, data.user_ids)
+    return GroupMembersResult(changed=added, unknown_users=unknown)
+
+@router.delete("/{group_id}/members", response_model=GroupMembersResult)
+async def remove_members_from_group(group_id: str, data: GroupMembersUpdate):
+    """Remove users from a group, users who aren't members are skipped"""
+    group = await db.groups.find_one({"id": group_id}, {"_id": 1})
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    removed = await memberships.remove_members(db, group_id, data.user_ids)
+    await _membership_changed(removed, data.user_ids)
+    return GroupMembersResult(changed=removed)
+
 @router.post("/{group_id}/members/{user_id}")
 async def add_member_to_group(group_id: str, user_id: str):
     """Add a user to a group"""
-    group = await db.groups.find_one({"id": group_id})
+    group = await db.groups.find_one({"id": group_id}, {"_id": 1})
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
     
-    # Check if user exists
-    user = await db.users.find_one({"id": user_id})
-    if not user:
+    added, unknown = await memberships.add_members(db, group_id, [user_id])
+    if unknown:
         raise HTTPException(status_code=404, detail="User not found")
-    
-    # Increment members count
-    await db.groups.update_one(
-        {"id": group_id}, 
-        {"$inc": {"members": 1}}
-    )
+    if not added:
+        raise HTTPException(status_code=400, detail="User is already a member of this group")
+    await _membership_changed(added, [user_id])
     
     return {"message": "User added to group successfully"}
 
 @router.delete("/{group_id}/members/{user_id}")
 async def remove_member_from_group(group_id: str, user_id: str):
     """Remove a user from a group"""
-    group = await db.groups.find_one({"id": group_id})
+    group = await db.groups.find_one({"id": group_id}, {"_id": 1})
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
     
-    # Decrement members count (ensure it doesn't go below 0)
-    current_members = group.get("members", 0)
-    if current_members > 0:
-        await db.groups.update_one(
-            {"id": group_id}, 
-            {"$inc": {"members": -1}}
-        )
+    removed = await memberships.remove_members(db, group_id, [user_id])
+    if not removed:
+        raise HTTPException(status_code=404, detail="User is not a member of this group")
+    await _membership_changed(removed, [user_id])
     
-    return {"message": "User removed from group successfully"}
\ No newline at end of file
+    return {"message": "User removed from group successfully"}
@@ -1,49 +1,212 @@
-from fastapi import APIRouter, HTTPException
-from typing import List, Optional
-from models import OfficePlan, OfficePlanCreate, OfficePlanUpdate, OfficeElement, OfficeElementCreate, OfficeElementUpdate
+from fastapi import APIRouter, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from typing import List, Literal, Optional, Union
+from models import (
+    OfficePlan, OfficePlanSummary, OfficePlanCreate, OfficePlanUpdate, OfficeElement, OfficeElementCreate, OfficeElementUpdate,
+    BatchOperationType, OfficeElementOperation, OfficeElementBatch, OfficeElementOperationResult, OfficeElementBatchResult,
+    NearestDesk, PlanVersion
+)
 from datetime import datetime
+import asyncio
+import math
+from pymongo import ASCENDING, InsertOne, UpdateOne, DeleteOne, ReturnDocument
+from pymongo.errors import BulkWriteError
+from pagination import fetch_page, MAX_PAGE_SIZE, NEXT_CURSOR_HEADER
+from streaming import JSON_MEDIA_TYPE, stream_documents, stream_with_array
+from spatial import GEOMETRY_FIELDS, center, nearest_elements, box_filter, changes_geometry, parse_bbox, spatial_fields, valid_coordinate, with_spatial_fields, MAX_COORDINATE
+from collisions import GEOMETRY_PROJECTION, batch_collisions, find_collisions
+from plan_feed import plan_feed
+from plan_changes import log_changes, plan_changed
+import plan_history
+import etags
+from exports import export_response
+from serialization import TrustedJSONResponse, dumps, parse_fields, project, projection
+from plan_cache import plan_cache
+from search import search_page, search_update, with_search_terms
+from user_loader import UserLoader, parse_expand
 import os
 
 router = APIRouter()
 
 # MongoDB connection
 from server import db
+from routes.statistics import record_change, record_delta
+import counters
 
-@router.get("/", response_model=List[OfficePlan])
+# User references that expand= can embed, see user_loader.py
+PLAN_EXPANDABLE = ("created_by",)
+ELEMENT_EXPANDABLE = ("assigned_to",)
+
+def _with_users(result: dict, document: dict, expanded: List[str]) -> dict:
+    """result with the users embedded in document by UserLoader.expand"""
+    for field in expanded:
+        result[f"{field}_user"] = document.get(f"{field}_user")
+    return result
+
+def _element_json(element: dict, names: Optional[List[str]] = None, expanded: List[str] = ()) -> bytes:
+    return dumps(_with_users(project(element, OfficeElement, names), element, expanded))
+
+def _plan_json(plan: dict, names: Optional[List[str]] = None, expanded: List[str] = ()) -> bytes:
+    """The plan without its elements, which are streamed separately"""
+    result = _with_users(project(plan, OfficePlan, names), plan, expanded)
+    result.pop("elements", None)
+    return dumps(result)
+
+def _split_expand(expand: Optional[str]):
+    """Plan and element fields listed in expand="""
+    expanded = parse_expand(expand, PLAN_EXPANDABLE + ELEMENT_EXPANDABLE)
+    return [field for field in expanded if field in PLAN_EXPANDABLE], [field for field in expanded if field in ELEMENT_EXPANDABLE]
+
+def _stored_fields(names: Optional[List[str]]) -> Optional[List[str]]:
+    """Plan fields to load for the requested names, elements and counts coming from office_elements"""
+    if names is None:
+        return None
+    return [name for name in names if name not in ("elements", "element_count")]
+
+async def _reject_collisions(plan_id: str, element: dict):
+    """Raise a 409 listing the elements that element would overlap"""
+    collisions = await find_collisions(db, plan_id, [element])
+    if collisions:
+        raise HTTPException(status_code=409, detail={
+            "message": "Element overlaps other elements, use force=true to save it anyway",
+            "conflicts": collisions[element["id"]]
+        })
+
+def _element_op(before: Optional[dict], after: Optional[dict]) -> Optional[dict]:
+    """Change feed operation turning element before into after, None when nothing changed"""
+    if before is None:
+        return {"op": "create", "id": after["id"], "element": OfficeElement(**after).dict()}
+    if after is None:
+        return {"op": "delete", "id": before["id"]}
+    changes = {
+        field: after[field] for field in OfficeElement.model_fields
+        if field in after and after[field] != before.get(field)
+    }
+    return {"op": "update", "id": after["id"], "changes": changes} if changes else None
+
+def _geometry_guard(element: dict, changes: dict) -> dict:
+    """Filter on the geometry fields changes leaves alone, which the spatial fields computed from element assume"""
+    if not changes_geometry(changes):
+        return {}
+    return {field: element.get(field) for field in GEOMETRY_FIELDS if field not in changes}
+
+async def _unreached(plan_id: str, element_ids: List[str], written_at: datetime) -> set:
+    """Ids among element_ids not stamped written_at, their update having matched nothing"""
+    reached = await db.office_elements.distinct(
+        "id", {"office_plan_id": plan_id, "id": {"$in": element_ids}, "updated_at": written_at}
+    )
+    return set(element_ids) - set(reached)
+
+# Pipeline stage bumping the version of a plan updated through search_update
+_BUMP_VERSION = {"$set": {"version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}}}
+
+def _stream_plan(plan: dict, names: Optional[List[str]] = None, plan_expanded: List[str] = (),
+                 element_expanded: List[str] = (), loader: Optional[UserLoader] = None):
+    """Stream a plan with all its elements, read from the database as they are sent
+    
+    With names, only those plan fields are returned, and elements only when listed.
+    The users of plan_expanded must already be embedded in plan, the ones of
+    element_expanded are resolved by loader as elements are read.
+    """
+    if names is not None and "elements" not in names:
+        return TrustedJSONResponse(_with_users(project(plan, OfficePlan, names), plan, plan_expanded))
+    elements = db.office_elements.find({"office_plan_id": plan["id"]}).sort("id", ASCENDING)
+    if element_expanded:
+        elements = loader.expand_batches(elements, element_expanded)
+    return stream_with_array(
+        _plan_json(plan, names, plan_expanded), "elements", elements,
+        lambda element: _element_json(element, None, element_expanded)
+    )
+
+@router.get("/", response_model=List[Union[OfficePlanSummary, OfficePlan]])
 async def get_office_plans(
-    skip: int = 0,
-    limit: int = 100,
+    request: Request,
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     search: Optional[str] = None,
     created_by: Optional[str] = None,
-    is_active: Optional[bool] = None
+    is_active: Optional[bool] = None,
+    include_elements: bool = True,
+    fields: Optional[str] = None,
+    expand: Optional[str] = None
 ):
-    """Get all office plans with optional filtering"""
+    """Get all office plans with optional filtering
+    
+    With include_elements=false only plan metadata and an element count are returned.
+    fields=id,name,... restricts the returned fields, elements included, or element_count
+    with include_elements=false.
+    expand=created_by,assigned_to embeds the plan's author and the elements' assignees
+    as created_by_user and assigned_to_user.
+    """
+    names = parse_fields(fields, OfficePlan if include_elements else OfficePlanSummary)
+    plan_expanded, element_expanded = _split_expand(expand)
+    plan_projection = projection(_stored_fields(names), "id", *plan_expanded)
     query = {}
     
-    # Build search query
-    if search:
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}},
-            {"created_by": {"$regex": search, "$options": "i"}}
-        ]
-    
     if created_by:
         query["created_by"] = created_by
     if is_active is not None:
         query["is_active"] = is_active
     
+    # Element writes also bump the office_elements revision
+    not_modified = etags.check(request, response, await etags.list_etag(
+        db, request, "office_plans", "office_elements", *(["users"] if plan_expanded or element_expanded else [])
+    ))
+    if not_modified:
+        return not_modified
+    
     # Get plans
-    plans = await db.office_plans.find(query).skip(skip).limit(limit).to_list(limit)
+    if search:
+        plans = await search_page(
+            db.office_plans, query, search, skip=skip, limit=limit, cursor=cursor, projection=plan_projection
+        )
+    else:
+        plans = await fetch_page(
+            db.office_plans, query, response, skip=skip, limit=limit, cursor=cursor, projection=plan_projection
+        )
+    
+    plan_ids = [plan["id"] for plan in plans]
+    
+    if not include_elements:
+        # Count elements of every plan in a single aggregation
+        counts = {}
+        if names is None or "element_count" in names:
+            async for row in db.office_elements.aggregate([
+                {"$match": {"office_plan_id": {"$in": plan_ids}}},
+                {"$group": {"_id": "$office_plan_id", "count": {"$sum": 1}}}
+            ]):
+                counts[row["_id"]] = row["count"]
+        result = [
+            project({**plan, "element_count": counts.get(plan["id"], 0)}, OfficePlanSummary, names) for plan in plans
+        ]
+        await UserLoader(db).expand(plans, plan_expanded, result)
+        return TrustedJSONResponse(result, headers=response.headers)
+    
+    # Fetch the elements of every plan in a single query and group them by plan
+    elements_by_plan = {plan_id: [] for plan_id in plan_ids}
+    if names is None or "elements" in names:
+        async for element in db.office_elements.find({"office_plan_id": {"$in": plan_ids}}):
+            elements_by_plan[element["office_plan_id"]].append(element)
     
-    # Get elements for each plan
     result = []
+    elements, element_results = [], []
     for plan in plans:
-        elements = await db.office_elements.find({"office_plan_id": plan["id"]}).to_list(1000)
-        plan["elements"] = [OfficeElement(**element) for element in elements]
-        result.append(OfficePlan(**plan))
-    
-    return result
+        projected = project(plan, OfficePlan, names)
+        if "elements" in projected:
+            projected["elements"] = [project(element, OfficeElement) for element in elements_by_plan[plan["id"]]]
+            elements.extend(elements_by_plan[plan["id"]])
+            element_results.extend(projected["elements"])
+        result.append(projected)
+    
+    # Authors and assignees of the whole page are resolved together
+    loader = UserLoader(db)
+    await asyncio.gather(
+        loader.expand(plans, plan_expanded, result),
+        loader.expand(elements, element_expanded, element_results)
+    )
+    return TrustedJSONResponse(result, headers=response.headers)
 
 @router.post("/", response_model=OfficePlan)
 async def create_office_plan(plan_data: OfficePlanCreate):
@@ -59,56 +222,129 @@ async def create_office_plan(plan_data: OfficePlanCreate):
     plan_dict = plan_data.dict()
     plan = OfficePlan(**plan_dict)
     
-    await db.office_plans.insert_one(plan.dict())
+    await db.office_plans.insert_one(with_search_terms("office_plans", plan.dict()))
+    await record_change("office_plans", after=plan.dict())
+    await plan_history.snapshot(db, plan.dict())
     return plan
 
 @router.get("/{plan_id}", response_model=OfficePlan)
-async def get_office_plan(plan_id: str):
-    """Get a specific office plan by ID"""
-    plan = await db.office_plans.find_one({"id": plan_id})
+async def get_office_plan(
+    plan_id: str,
+    request: Request,
+    at: Optional[int] = Query(None, ge=0),
+    fields: Optional[str] = None,
+    expand: Optional[str] = None
+):
+    """Get a specific office plan by ID
+    
+    With at=<version>, the plan and its elements are returned as they were at that version.
+    fields=id,name,... restricts the returned fields, elements included.
+    expand=created_by,assigned_to embeds the plan's author and the elements' assignees.
+    A request whose If-None-Match holds the plan's current ETag gets a 304
+    without any element being read. The current version is served from the
+    plan cache when it holds it.
+    """
+    names = parse_fields(fields, OfficePlan)
+    plan_expanded, element_expanded = _split_expand(expand)
+    plan = await db.office_plans.find_one(
+        {"id": plan_id}, projection(_stored_fields(names), "id", "version", *plan_expanded)
+    )
     if not plan:
         raise HTTPException(status_code=404, detail="Office plan not found")
     
-    # Get elements for this plan
-    elements = await db.office_elements.find({"office_plan_id": plan_id}).to_list(1000)
-    plan["elements"] = [OfficeElement(**element) for element in elements]
-    
-    return OfficePlan(**plan)
+    version = plan.get("version", 0)
+    etag = etags.plan_etag(plan_id, version, request)
+    if plan_expanded or element_expanded:
+        etag = await etags.with_revisions(db, etag, "users")
+    not_modified = etags.not_modified(request, etag)
+    if not_modified:
+        return not_modified
+    
+    loader = UserLoader(db)
+    if at is not None and at != version:
+        plan, elements = await _plan_at(plan, at)
+        await asyncio.gather(loader.expand([plan], plan_expanded), loader.expand(elements, element_expanded))
+        if names is not None and "elements" not in names:
+            streamed = TrustedJSONResponse(_with_users(project(plan, OfficePlan, names), plan, plan_expanded))
+        else:
+            streamed = stream_with_array(
+                _plan_json(plan, names, plan_expanded), "elements", elements,
+                lambda element: _element_json(element, None, element_expanded)
+            )
+        streamed.headers["ETag"] = etag
+        return streamed
+    
+    if names is not None or plan_expanded or element_expanded:
+        await loader.expand([plan], plan_expanded)
+        streamed = _stream_plan(plan, names, plan_expanded, element_expanded, loader)
+        streamed.headers["ETag"] = etag
+        return streamed
+    
+    body = await plan_cache.get(plan_id, version)
+    if body is not None:
+        return Response(body, media_type=JSON_MEDIA_TYPE, headers={"ETag": etag})
+    
+    # Stream elements for this plan, keeping the body for the next requests
+    streamed = _stream_plan(plan)
+    streamed.body_iterator = plan_cache.capture(plan_id, version, streamed.body_iterator)
+    streamed.headers["ETag"] = etag
+    return streamed
+
+async def _plan_at(plan: dict, version: int):
+    """The plan and its elements at a past version, 404 when it is not available"""
+    if version > plan.get("version", 0):
+        raise HTTPException(status_code=404, detail="Version not found")
+    state = await plan_history.reconstruct(db, plan["id"], version)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Version no longer available")
+    return state
 
 @router.put("/{plan_id}", response_model=OfficePlan)
 async def update_office_plan(plan_id: str, plan_data: OfficePlanUpdate):
     """Update an office plan"""
-    plan = await db.office_plans.find_one({"id": plan_id})
-    if not plan:
-        raise HTTPException(status_code=404, detail="Office plan not found")
-    
     update_data = {k: v for k, v in plan_data.dict().items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
     
-    await db.office_plans.update_one({"id": plan_id}, {"$set": update_data})
+    plan = await db.office_plans.find_one_and_update(
+        {"id": plan_id},
+        search_update("office_plans", update_data) + [_BUMP_VERSION],
+        return_document=ReturnDocument.BEFORE
+    )
+    if not plan:
+        raise HTTPException(status_code=404, detail="Office plan not found")
     
     # Get updated plan with elements
-    updated_plan = await db.office_plans.find_one({"id": plan_id})
-    elements = await db.office_elements.find({"office_plan_id": plan_id}).to_list(1000)
-    updated_plan["elements"] = [OfficeElement(**element) for element in elements]
+    updated_plan = {**plan, **update_data, "version": plan.get("version", 0) + 1}
+    await record_change("office_plans", before=plan, after=updated_plan)
+    await log_changes(db, plan_id, updated_plan["version"], [{"op": "plan", "changes": update_data}])
     
-    return OfficePlan(**updated_plan)
+    return _stream_plan(updated_plan)
 
 @router.delete("/{plan_id}")
 async def delete_office_plan(plan_id: str):
     """Delete an office plan and all its elements"""
-    result = await db.office_plans.delete_one({"id": plan_id})
-    if result.deleted_count == 0:
+    plan = await db.office_plans.find_one_and_delete({"id": plan_id})
+    if not plan:
         raise HTTPException(status_code=404, detail="Office plan not found")
     
     # Delete all elements associated with this plan
+    removed = await counters.grouped_delta(db, "office_elements", {"office_plan_id": plan_id}, -1)
     await db.office_elements.delete_many({"office_plan_id": plan_id})
+    await record_delta(counters.merge_deltas(
+        removed, counters.counter_delta("office_plans", plan, -1), counters.revision_delta("office_plans", "office_elements")
+    ))
+    await plan_history.delete_history(db, plan_id)
+    await plan_cache.invalidate(plan_id)
+    await plan_feed.publish(db, plan_id, plan.get("version", 0) + 1, [{"op": "plan_deleted"}])
     
     return {"message": "Office plan deleted successfully"}
 
 @router.post("/{plan_id}/elements", response_model=OfficeElement)
-async def add_element_to_plan(plan_id: str, element_data: OfficeElementCreate):
-    """Add an element to an office plan"""
+async def add_element_to_plan(plan_id: str, element_data: OfficeElementCreate, force: bool = False):
+    """Add an element to an office plan
+    
+    Overlapping other elements is rejected with a 409 unless force is set.
+    """
     # Check if plan exists
     plan = await db.office_plans.find_one({"id": plan_id})
     if not plan:
@@ -120,74 +356,475 @@ async def add_element_to_plan(plan_id: str, element_data: OfficeElementCreate):
     element_dict = element_data.dict()
     element = OfficeElement(**element_dict)
     
-    await db.office_elements.insert_one(element.dict())
+    if not force:
+        await _reject_collisions(plan_id, element.dict())
     
-    # Update plan's updated_at
-    await db.office_plans.update_one(
-        {"id": plan_id},
-        {"$set": {"updated_at": datetime.utcnow()}}
-    )
+    await db.office_elements.insert_one(with_spatial_fields({**element.dict(), "updated_at": datetime.utcnow()}))
+    await record_change("office_elements", after=element.dict())
+    await plan_changed(db, plan_id, [_element_op(None, element.dict())])
     
     return element
 
 @router.get("/{plan_id}/elements", response_model=List[OfficeElement])
-async def get_plan_elements(plan_id: str):
-    """Get all elements for a specific plan"""
-    # Check if plan exists
-    plan = await db.office_plans.find_one({"id": plan_id})
+async def get_plan_elements(
+    plan_id: str,
+    request: Request,
+    bbox: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    format: Literal["json", "ndjson"] = "json",
+    fields: Optional[str] = None,
+    expand: Optional[str] = None
+):
+    """Get all elements for a specific plan
+    
+    Elements are streamed from the database cursor as a JSON array, or as one
+    element per line with format=ndjson. bbox=x0,y0,x1,y1 restricts them to the
+    ones intersecting that viewport through the spatial grid index. With limit,
+    a single page sorted by id is returned and the X-Next-Cursor header holds
+    the value to pass as after. fields=id,name,... restricts the returned fields.
+    expand=assigned_to embeds the assigned user as assigned_to_user.
+    """
+    names = parse_fields(fields, OfficeElement)
+    expanded = parse_expand(expand, ELEMENT_EXPANDABLE)
+    
+    # Check if plan exists, its version tags the elements
+    plan = await db.office_plans.find_one({"id": plan_id}, {"_id": 0, "version": 1})
     if not plan:
         raise HTTPException(status_code=404, detail="Office plan not found")
     
-    elements = await db.office_elements.find({"office_plan_id": plan_id}).to_list(1000)
-    return [OfficeElement(**element) for element in elements]
+    etag = etags.plan_etag(plan_id, plan.get("version", 0), request)
+    if expanded:
+        etag = await etags.with_revisions(db, etag, "users")
+    not_modified = etags.not_modified(request, etag)
+    if not_modified:
+        return not_modified
+    
+    query = {"office_plan_id": plan_id}
+    if bbox:
+        try:
+            query.update(box_filter(parse_bbox(bbox)))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="bbox must be x0,y0,x1,y1")
+    if after:
+        query["id"] = {"$gt": after}
+    elements = db.office_elements.find(query, projection(names, "id", *expanded)).sort("id", ASCENDING)
+    
+    headers = {"ETag": etag}
+    loader = UserLoader(db)
+    if limit:
+        elements = await elements.limit(limit).to_list(limit)
+        if len(elements) == limit:
+            headers[NEXT_CURSOR_HEADER] = elements[-1]["id"]
+        await loader.expand(elements, expanded)
+    elif expanded:
+        elements = loader.expand_batches(elements, expanded)
+    
+    return stream_documents(elements, lambda element: _element_json(element, names, expanded), format, headers)
 
-@router.put("/{plan_id}/elements/{element_id}", response_model=OfficeElement)
-async def update_plan_element(plan_id: str, element_id: str, element_data: OfficeElementUpdate):
-    """Update an element in an office plan"""
-    element = await db.office_elements.find_one({
-        "id": element_id,
-        "office_plan_id": plan_id
-    })
-    if not element:
-        raise HTTPException(status_code=404, detail="Element not found in this plan")
-    
-    update_data = {k: v for k, v in element_data.dict().items() if v is not None}
+@router.get("/{plan_id}/elements/export")
+async def export_plan_elements(
+    plan_id: str,
+    format: Literal["ndjson", "csv"] = "ndjson",
+    since: Optional[datetime] = None,
+    bbox: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """Stream every element of a plan, or of the bbox viewport, as NDJSON or CSV
+
+    since=<updated_at> only exports the elements created or updated since then, see exports.py.
+    """
+    plan = await db.office_plans.find_one({"id": plan_id}, {"_id": 1})
+    if not plan:
+        raise HTTPException(status_code=404, detail="Office plan not found")
     
-    await db.office_elements.update_one(
-        {"id": element_id},
-        {"$set": update_data}
+    query = {"office_plan_id": plan_id}
+    if bbox:
+        try:
+            query.update(box_filter(parse_bbox(bbox)))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="bbox must be x0,y0,x1,y1")
+    return export_response(
+        db.office_elements, query, OfficeElement, format, f"plan-{plan_id}-elements", since,
+        parse_fields(fields, OfficeElement), sort=[("id", ASCENDING)]
     )
+
+@router.put("/{plan_id}/elements/{element_id}", response_model=OfficeElement)
+async def update_plan_element(plan_id: str, element_id: str, element_data: OfficeElementUpdate, force: bool = False):
+    """Update an element in an office plan
     
-    # Update plan's updated_at
-    await db.office_plans.update_one(
-        {"id": plan_id},
-        {"$set": {"updated_at": datetime.utcnow()}}
+    Moving it over other elements is rejected with a 409 unless force is set.
+    """
+    update_data = {k: v for k, v in element_data.dict().items() if v is not None}
+    query = {"id": element_id, "office_plan_id": plan_id}
+    
+    spatial = {}
+    if changes_geometry(update_data):
+        element = await db.office_elements.find_one(query, GEOMETRY_PROJECTION)
+        if not element:
+            raise HTTPException(status_code=404, detail="Element not found in this plan")
+        geometry = {**element, **update_data}
+        if not force:
+            await _reject_collisions(plan_id, geometry)
+        spatial = spatial_fields(geometry)
+        # The spatial fields only hold if the geometry left unchanged is still the one read
+        query.update(_geometry_guard(element, update_data))
+    
+    element = await db.office_elements.find_one_and_update(
+        query,
+        {"$set": {**update_data, **spatial, "updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.BEFORE
     )
+    if not element:
+        if spatial and await db.office_elements.count_documents({"id": element_id, "office_plan_id": plan_id}, limit=1):
+            raise HTTPException(status_code=409, detail="The element was moved meanwhile, try again")
+        raise HTTPException(status_code=404, detail="Element not found in this plan")
     
-    updated_element = await db.office_elements.find_one({"id": element_id})
+    updated_element = {**element, **update_data, **spatial}
+    await record_change("office_elements", before=element, after=updated_element)
+    await plan_changed(db, plan_id, [_element_op(element, updated_element)])
     return OfficeElement(**updated_element)
 
 @router.delete("/{plan_id}/elements/{element_id}")
 async def delete_plan_element(plan_id: str, element_id: str):
     """Delete an element from an office plan"""
-    result = await db.office_elements.delete_one({
+    element = await db.office_elements.find_one_and_delete({
         "id": element_id,
         "office_plan_id": plan_id
     })
-    if result.deleted_count == 0:
+    if not element:
+        raise HTTPException(status_code=404, detail="Element not found in this plan")
+    await record_change("office_elements", before=element)
+    await plan_changed(db, plan_id, [_element_op(element, None)])
+    
+    return {"message": "Element deleted successfully"}
+
+def _prepare_operation(plan_id: str, operation: OfficeElementOperation, existing: dict, now: datetime):
+    """Turn a batch operation into (element id, write request, document before, document after)
+
+    Raises ValueError with the message reported for the operation when it can't be applied.
+    """
+    if operation.op == BatchOperationType.CREATE:
+        if operation.element is None:
+            raise ValueError("Missing element for create")
+        element = OfficeElement(**{**operation.element.dict(), "office_plan_id": plan_id})
+        document = with_spatial_fields({**element.dict(), "updated_at": now})
+        return element.id, InsertOne(document), None, document
+    
+    element = existing.get(operation.id)
+    if element is None:
+        raise ValueError("Element not found in this plan")
+    
+    if operation.op == BatchOperationType.UPDATE:
+        if operation.changes is None:
+            raise ValueError("Missing changes for update")
+        update_data = {k: v for k, v in operation.changes.dict().items() if v is not None}
+        if not update_data:
+            raise ValueError("No changes for update")
+        updated_element = {**element, **update_data}
+        guard = _geometry_guard(element, update_data)
+        if changes_geometry(update_data):
+            update_data = {**update_data, **spatial_fields(updated_element)}
+        request = UpdateOne(
+            {"id": operation.id, "office_plan_id": plan_id, **guard},
+            {"$set": {**update_data, "updated_at": now}}
+        )
+        return operation.id, request, element, updated_element
+    
+    return operation.id, DeleteOne({"id": operation.id, "office_plan_id": plan_id}), element, None
+
+@router.post("/{plan_id}/elements:batch", response_model=OfficeElementBatchResult)
+async def batch_plan_elements(plan_id: str, batch: OfficeElementBatch):
+    """Create, update and delete several elements of an office plan in one bulk write"""
+    plan = await db.office_plans.find_one({"id": plan_id}, {"_id": 1})
+    if not plan:
+        raise HTTPException(status_code=404, detail="Office plan not found")
+    
+    # Load every element targeted by an update or a delete in a single query
+    target_ids = [
+        operation.id for operation in batch.operations
+        if operation.op != BatchOperationType.CREATE and operation.id
+    ]
+    existing = {}
+    if target_ids:
+        async for element in db.office_elements.find({"office_plan_id": plan_id, "id": {"$in": target_ids}}):
+            existing[element["id"]] = element
+    
+    results = []
+    pending = []  # (result, request, before, after) for each operation sent to Mongo
+    seen_ids = set()
+    now = datetime.utcnow()
+    for index, operation in enumerate(batch.operations):
+        result = OfficeElementOperationResult(index=index, op=operation.op, id=operation.id, ok=False)
+        results.append(result)
+        # Unordered writes on the same element would race each other
+        if operation.id and operation.id in seen_ids:
+            result.error = "Element appears more than once in this batch"
+            continue
+        try:
+            element_id, request, before, after = _prepare_operation(plan_id, operation, existing, now)
+        except ValueError as exc:
+            result.error = str(exc)
+            continue
+        seen_ids.add(element_id)
+        result.id = element_id
+        result.ok = True
+        pending.append((result, request, before, after))
+    
+    if pending and not batch.force:
+        # Check every created or moved element against the plan and each other
+        moved = [
+            after for _, _, before, after in pending
+            if after is not None and (before is None or any(before.get(f) != after.get(f) for f in GEOMETRY_FIELDS))
+        ]
+        deleted_ids = [before["id"] for _, _, before, after in pending if after is None]
+        collisions = await batch_collisions(db, plan_id, moved, deleted_ids)
+        for result, _, _, _ in pending:
+            if result.id in collisions:
+                result.ok = False
+                result.error = "Element overlaps other elements"
+                result.conflicts = collisions[result.id]
+        pending = [operation for operation in pending if operation[0].ok]
+    
+    if pending:
+        try:
+            written = await db.office_elements.bulk_write([request for _, request, _, _ in pending], ordered=False)
+            matched = written.matched_count
+        except BulkWriteError as exc:
+            for error in exc.details["writeErrors"]:
+                result = pending[error["index"]][0]
+                result.ok = False
+                result.error = error["errmsg"]
+            matched = exc.details["nMatched"]
+        
+        updated_ids = [result.id for result, request, _, _ in pending if result.ok and isinstance(request, UpdateOne)]
+        if matched < len(updated_ids):
+            # Updates of elements moved or deleted meanwhile matched nothing
+            unreached = await _unreached(plan_id, updated_ids, now)
+            for result, _, _, _ in pending:
+                if result.id in unreached:
+                    result.ok = False
+                    result.error = "Element changed meanwhile, try again"
+        
+        applied = [(before, after) for result, _, before, after in pending if result.ok]
+        if applied:
+            await record_delta(counters.merge_deltas(counters.revision_delta("office_elements"), *[
+                counters.change_delta("office_elements", before, after) for before, after in applied
+            ]))
+            # Bump the plan's version once for the whole batch
+            await plan_changed(db, plan_id, [_element_op(before, after) for before, after in applied])
+    
+    succeeded = [result.op for result in results if result.ok]
+    return OfficeElementBatchResult(
+        created=succeeded.count(BatchOperationType.CREATE),
+        updated=succeeded.count(BatchOperationType.UPDATE),
+        deleted=succeeded.count(BatchOperationType.DELETE),
+        results=results
+    )
+
+async def _nearest_desks(plan_id: str, x: float, y: float, k: int, exclude_id: Optional[str] = None):
+    if not (valid_coordinate(x) and valid_coordinate(y)):
+        raise HTTPException(status_code=400, detail=f"x and y must be finite and within {MAX_COORDINATE:g}")
+    plan = await db.office_plans.find_one({"id": plan_id}, {"width": 1, "height": 1})
+    if not plan:
+        raise HTTPException(status_code=404, detail="Office plan not found")
+    
+    # Beyond this radius every point of the plan has been searched
+    max_radius = math.hypot(max(abs(x), abs(plan["width"] - x)), max(abs(y), abs(plan["height"] - y)))
+    desks = await nearest_elements(
+        db, plan_id, x, y, k,
+        {"type": "desk", "status": "available"},
+        max_radius,
+        exclude_id=exclude_id
+    )
+    return TrustedJSONResponse([
+        {"distance": distance, "element": project(desk, OfficeElement)} for distance, desk in desks
+    ])
+
+@router.get("/{plan_id}/desks/nearest", response_model=List[NearestDesk])
+async def get_nearest_desks(plan_id: str, x: float, y: float, k: int = Query(5, ge=1, le=50)):
+    """Get the k available desks closest to a point of the plan"""
+    return await _nearest_desks(plan_id, x, y, k)
+
+@router.get("/{plan_id}/elements/{element_id}/desks/nearest", response_model=List[NearestDesk])
+async def get_desks_nearest_to_element(plan_id: str, element_id: str, k: int = Query(5, ge=1, le=50)):
+    """Get the k available desks closest to an element of the plan, such as a team desk or a meeting room"""
+    element = await db.office_elements.find_one({"id": element_id, "office_plan_id": plan_id}, GEOMETRY_PROJECTION)
+    if not element:
         raise HTTPException(status_code=404, detail="Element not found in this plan")
+    x, y = center(element)
+    return await _nearest_desks(plan_id, x, y, k, exclude_id=element_id)
+
+@router.get("/{plan_id}/versions", response_model=List[PlanVersion])
+async def get_plan_versions(
+    plan_id: str,
+    request: Request,
+    response: Response,
+    limit: int = Query(50, ge=1, le=500),
+    before: Optional[int] = None
+):
+    """Get the history of a plan, newest version first
+    
+    When a full page is returned, the X-Next-Cursor header holds the value to pass as before.
+    """
+    plan = await db.office_plans.find_one({"id": plan_id}, {"_id": 0, "version": 1})
+    if not plan:
+        raise HTTPException(status_code=404, detail="Office plan not found")
+    not_modified = etags.check(request, response, etags.plan_etag(plan_id, plan.get("version", 0), request))
+    if not_modified:
+        return not_modified
+    
+    versions = await plan_history.versions(db, plan_id, limit, before)
+    if len(versions) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = str(versions[-1]["version"])
+    return versions
+
+@router.post("/{plan_id}/revert", response_model=OfficePlan)
+async def revert_office_plan(plan_id: str, version: int = Query(..., ge=0)):
+    """Restore a plan and its elements as they were at a previous version
     
-    # Update plan's updated_at
-    await db.office_plans.update_one(
+    Only the differences with the current state are written, as a new version
+    that can itself be reverted.
+    """
+    plan = await db.office_plans.find_one({"id": plan_id})
+    if not plan:
+        raise HTTPException(status_code=404, detail="Office plan not found")
+    target_plan, target_elements = await _plan_at(plan, version)
+    
+    current = {}
+    async for element in db.office_elements.find({"office_plan_id": plan_id}):
+        current[element["id"]] = element
+    
+    pending = []  # (write request, document before, document after)
+    now = datetime.utcnow()
+    for element in target_elements:
+        before = current.get(element["id"])
+        if before is None:
+            document = with_spatial_fields({**element, "updated_at": now})
+            pending.append((InsertOne(document), None, document))
+            continue
+        op = _element_op(before, element)
+        if op:
+            changes = op["changes"]
+            guard = _geometry_guard(before, changes)
+            if changes_geometry(changes):
+                changes = {**changes, **spatial_fields(element)}
+            request = UpdateOne(
+                {"id": element["id"], "office_plan_id": plan_id, **guard},
+                {"$set": {**changes, "updated_at": now}}
+            )
+            pending.append((request, before, {**before, **op["changes"]}))
+    target_ids = {element["id"] for element in target_elements}
+    for element_id, element in current.items():
+        if element_id not in target_ids:
+            pending.append((DeleteOne({"id": element_id, "office_plan_id": plan_id}), element, None))
+    
+    failed = set()
+    if pending:
+        try:
+            written = await db.office_elements.bulk_write([request for request, _, _ in pending], ordered=False)
+            matched = written.matched_count
+        except BulkWriteError as exc:
+            failed = {error["index"] for error in exc.details["writeErrors"]}
+            matched = exc.details["nMatched"]
+        updates = {
+            before["id"]: index for index, (request, before, _) in enumerate(pending)
+            if isinstance(request, UpdateOne) and index not in failed
+        }
+        if matched < len(updates):
+            # Updates of elements moved or deleted meanwhile matched nothing
+            failed |= {updates[element_id] for element_id in await _unreached(plan_id, list(updates), now)}
+    applied = [(before, after) for index, (_, before, after) in enumerate(pending) if index not in failed]
+    
+    plan_changes = {
+        field: target_plan[field] for field in OfficePlanUpdate.model_fields
+        if field in target_plan and target_plan[field] != plan.get(field)
+    }
+    update_data = {**plan_changes, "updated_at": datetime.utcnow()}
+    plan = await db.office_plans.find_one_and_update(
         {"id": plan_id},
-        {"$set": {"updated_at": datetime.utcnow()}}
+        search_update("office_plans", update_data) + [_BUMP_VERSION],
+        return_document=ReturnDocument.BEFORE
     )
+    if not plan:
+        raise HTTPException(status_code=404, detail="Office plan not found")
     
-    return {"message": "Element deleted successfully"}
+    updated_plan = {**plan, **update_data, "version": plan.get("version", 0) + 1}
+    await record_delta(counters.merge_deltas(
+        counters.revision_delta("office_plans", "office_elements"),
+        counters.change_delta("office_plans", plan, updated_plan),
+        *[counters.change_delta("office_elements", before, after) for before, after in applied]
+    ))
+    ops = [{"op": "plan", "changes": update_data}] if plan_changes else []
+    await log_changes(db, plan_id, updated_plan["version"], ops + [_element_op(before, after) for before, after in applied])
+    
+    if failed:
+        raise HTTPException(status_code=409, detail="Some elements changed while the plan was reverted, try again")
+    return _stream_plan(updated_plan)
 
-@router.post("/{plan_id}/duplicate")
+@router.websocket("/{plan_id}/feed")
+async def plan_change_feed(websocket: WebSocket, plan_id: str, since: Optional[int] = None):
+    """Push element-level changes of a plan as they are written
+    
+    A client resuming with since=<last seq received> gets the deltas it missed
+    when they are still available, otherwise a snapshot of the plan and its
+    elements carrying the seq the following deltas build on.
+    """
+    plan = await db.office_plans.find_one({"id": plan_id})
+    if not plan:
+        await websocket.close(code=4404)
+        return
+    await websocket.accept()
+    
+    # Subscribe before reading the plan so nothing written meanwhile is lost
+    queue = plan_feed.subscribe(plan_id)
+    try:
+        plan = await db.office_plans.find_one({"id": plan_id})
+        if not plan:
+            await websocket.close(code=4404)
+            return
+        seq = plan.get("version", 0)
+        
+        missed = await plan_feed.missed(db, plan_id, since, seq) if since is not None else None
+        if missed is None:
+            elements = await db.office_elements.find({"office_plan_id": plan_id}).to_list(None)
+            await websocket.send_json(jsonable_encoder({
+                "type": "snapshot",
+                "plan_id": plan_id,
+                "seq": seq,
+                "plan": OfficePlan(**plan).dict(exclude={"elements"}),
+                "elements": [OfficeElement(**element) for element in elements]
+            }))
+            sent = set()
+        else:
+            for message in missed:
+                await websocket.send_json(message)
+            seq = since
+            sent = {message["seq"] for message in missed}
+        
+        while True:
+            message = await queue.get()
+            if message is None:
+                # Fell too far behind, the client resumes with its last seq
+                await websocket.close(code=1013)
+                return
+            if message["seq"] <= seq or message["seq"] in sent:
+                continue
+            await websocket.send_json(message)
+            if any(op["op"] == "plan_deleted" for op in message["ops"]):
+                await websocket.close()
+                return
+    except WebSocketDisconnect:
+        pass
+    finally:
+        plan_feed.unsubscribe(plan_id, queue)
+
+@router.post("/{plan_id}/duplicate", response_model=OfficePlanSummary)
 async def duplicate_office_plan(plan_id: str, new_name: str, created_by: str):
-    """Duplicate an office plan with all its elements"""
+    """Duplicate an office plan with all its elements
+    
+    Elements are copied server side and only the new plan is returned, with its element count.
+    """
     # Get original plan
     original_plan = await db.office_plans.find_one({"id": plan_id})
     if not original_plan:
@@ -210,28 +847,29 @@ async def duplicate_office_plan(plan_id: str, new_name: str, created_by: str):
         "updated_at": datetime.utcnow()
     }
     del new_plan_data["_id"]  # Remove MongoDB _id
+    del new_plan_data["id"]  # The copy gets its own id
+    new_plan_data["version"] = 0
     new_plan = OfficePlan(**new_plan_data)
     
-    await db.office_plans.insert_one(new_plan.dict())
-    
-    # Get and duplicate elements
-    original_elements = await db.office_elements.find({"office_plan_id": plan_id}).to_list(1000)
-    
-    new_elements = []
-    for element in original_elements:
-        del element["_id"]  # Remove MongoDB _id
-        new_element_data = {
-            **element,
-            "office_plan_id": new_plan.id
-        }
-        new_element = OfficeElement(**new_element_data)
-        new_elements.append(new_element.dict())
-    
-    if new_elements:
-        await db.office_elements.insert_many(new_elements)
-    
-    # Return new plan with elements
-    elements = await db.office_elements.find({"office_plan_id": new_plan.id}).to_list(1000)
-    new_plan.elements = [OfficeElement(**element) for element in elements]
-    
-    return new_plan
\ No newline at end of file
+    await db.office_plans.insert_one(with_search_terms("office_plans", new_plan.dict()))
+    
+    # Copy the elements without loading them: each copy gets a fresh _id and an
+    # id derived from the new plan id and the source _id, unique by construction
+    await db.office_elements.aggregate([
+        {"$match": {"office_plan_id": plan_id}},
+        {"$set": {
+            "id": {"$concat": [new_plan.id, ":", {"$toString": "$_id"}]},
+            "office_plan_id": new_plan.id,
+            "updated_at": "$$NOW"
+        }},
+        {"$unset": "_id"},
+        {"$merge": {"into": "office_elements", "whenMatched": "fail", "whenNotMatched": "insert"}}
+    ]).to_list(None)
+    
+    added = await counters.grouped_delta(db, "office_elements", {"office_plan_id": new_plan.id})
+    await record_delta(counters.merge_deltas(
+        added, counters.counter_delta("office_plans", new_plan.dict()), counters.revision_delta("office_plans", "office_elements")
+    ))
+    await plan_history.snapshot(db, new_plan.dict())
+    
+    return OfficePlanSummary(**new_plan.dict(), element_count=added.get("total_office_elements", 0))
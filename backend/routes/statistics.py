@@ -1,50 +1,54 @@
-from fastapi import APIRouter
-from models import Statistics
+from fastapi import APIRouter, Response
+from models import Statistics, PlanCacheStatistics
+from plan_cache import plan_cache
+from snapshot_cache import SnapshotCache
+import counters
+import os
 
 router = APIRouter()
 
 # MongoDB connection
 from server import db
 
+# Invalidated by every write route that changes a counted value
+statistics_cache = SnapshotCache()
+
+def _cache_ttl() -> float:
+    return float(os.environ.get("STATISTICS_CACHE_TTL", "30"))
+
+async def record_change(collection, before=None, after=None):
+    """Update the counters for a created, deleted or updated document"""
+    await counters.record_change(db, collection, before, after)
+    statistics_cache.invalidate()
+
+async def record_delta(delta):
+    """Apply precomputed counter changes, see counters.grouped_delta"""
+    await counters.apply_delta(db, delta)
+    statistics_cache.invalidate()
+
 @router.get("/", response_model=Statistics)
-async def get_statistics():
-    """Get application statistics"""
-    
-    # Count users
-    total_users = await db.users.count_documents({})
-    active_users = await db.users.count_documents({"status": "Actif"})
-    
-    # Count groups
-    total_groups = await db.groups.count_documents({})
-    
-    # Count equipments
-    total_equipments = await db.equipments.count_documents({})
-    equipments_in_service = await db.equipments.count_documents({"status": "En service"})
-    equipments_available = await db.equipments.count_documents({"status": "Disponible"})
-    equipments_in_maintenance = await db.equipments.count_documents({"status": "En maintenance"})
-    
-    # Count office plans and elements
-    total_office_plans = await db.office_plans.count_documents({"is_active": True})
-    total_office_elements = await db.office_elements.count_documents({})
-    available_desks = await db.office_elements.count_documents({
-        "type": "desk",
-        "status": "available"
-    })
-    occupied_desks = await db.office_elements.count_documents({
-        "type": "desk", 
-        "status": "occupied"
-    })
-    
-    return Statistics(
-        total_users=total_users,
-        active_users=active_users,
-        total_groups=total_groups,
-        total_equipments=total_equipments,
-        equipments_in_service=equipments_in_service,
-        equipments_available=equipments_available,
-        equipments_in_maintenance=equipments_in_maintenance,
-        total_office_plans=total_office_plans,
-        total_office_elements=total_office_elements,
-        available_desks=available_desks,
-        occupied_desks=occupied_desks
-    )
\ No newline at end of file
+async def get_statistics(response: Response):
+    """Get application statistics
+
+    Read from the incrementally maintained counters and cached for
+    STATISTICS_CACHE_TTL seconds, the Age header gives the snapshot's age.
+    """
+    cached = statistics_cache.get(_cache_ttl())
+    if cached:
+        statistics, age = cached
+    else:
+        generation = statistics_cache.generation
+        statistics = await counters.read_counters(db)
+        if statistics is None:
+            await counters.rebuild_counters(db)
+            statistics = await counters.read_counters(db)
+        statistics_cache.set(statistics, generation)
+        age = 0
+
+    response.headers["Age"] = str(int(age))
+    return statistics
+
+@router.get("/cache", response_model=PlanCacheStatistics)
+async def get_plan_cache_statistics():
+    """Get the hit, miss and eviction counters of this worker's plan cache"""
+    return plan_cache.stats()
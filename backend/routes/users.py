@@ -1,44 +1,73 @@
-from fastapi import APIRouter, HTTPException
-from typing import List, Optional
+from fastapi import APIRouter, File, HTTPException, Query, Request, Response, UploadFile
+from typing import List, Literal, Optional
 from motor.motor_asyncio import AsyncIOMotorClient
-from models import User, UserCreate, UserUpdate
+from models import User, UserCreate, UserUpdate, ImportReport, PropagationJob, Group, EffectivePermissions
 from datetime import datetime
+from pagination import MAX_PAGE_SIZE, fetch_page
+from search import search_page, search_update, with_search_terms
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import etags
+from exports import export_response, with_search
+from imports import detect_format, import_rows, read_rows
+from serialization import TrustedJSONResponse, parse_fields, project, projection
+from user_propagation import user_propagation
+import memberships
+from permissions import effective_permissions, permission_cache
 import os
 
 router = APIRouter()
 
 # MongoDB connection
 from server import db
+from routes.statistics import record_change, record_delta, statistics_cache
+import counters
+
+def _user_query(department: Optional[str], role: Optional[str], status: Optional[str]) -> dict:
+    """Filters shared by the list and export routes"""
+    query = {}
+    if department:
+        query["department"] = department
+    if role:
+        query["role"] = role
+    if status:
+        query["status"] = status
+    return query
 
 @router.get("/", response_model=List[User])
 async def get_users(
-    skip: int = 0,
-    limit: int = 100,
+    request: Request,
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     search: Optional[str] = None,
     department: Optional[str] = None,
     role: Optional[str] = None,
-    status: Optional[str] = None
+    status: Optional[str] = None,
+    fields: Optional[str] = None
 ):
-    """Get all users with optional filtering"""
-    query = {}
+    """Get all users with optional filtering
     
-    # Build search query
-    if search:
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"email": {"$regex": search, "$options": "i"}},
-            {"department": {"$regex": search, "$options": "i"}}
-        ]
+    fields=id,name,... restricts the returned fields.
+    """
+    names = parse_fields(fields, User)
+    query = _user_query(department, role, status)
     
-    if department:
-        query["department"] = department
-    if role:
-        query["role"] = role
-    if status:
-        query["status"] = status
+    # Tagged before reading, a write in between only makes the next request refetch
+    not_modified = etags.check(request, response, await etags.list_etag(db, request, "users"))
+    if not_modified:
+        return not_modified
     
-    users = await db.users.find(query).skip(skip).limit(limit).to_list(limit)
-    return [User(**user) for user in users]
+    if search:
+        users = await search_page(
+            db.users, query, search, skip=skip, limit=limit, cursor=cursor, projection=projection(names)
+        )
+    else:
+        users = await fetch_page(
+            db.users, query, response, skip=skip, limit=limit, cursor=cursor, projection=projection(names)
+        )
+    return TrustedJSONResponse([project(user, User, names) for user in users], headers=response.headers)
 
 @router.post("/", response_model=User)
 async def create_user(user_data: UserCreate):
@@ -51,49 +80,149 @@ async def create_user(user_data: UserCreate):
     user_dict = user_data.dict()
     user = User(**user_dict)
     
-    await db.users.insert_one(user.dict())
+    try:
+        await db.users.insert_one(with_search_terms("users", user.dict()))
+    except DuplicateKeyError:
+        # Registered meanwhile, caught by the unique email index
+        raise HTTPException(status_code=400, detail="Email already registered")
+    await record_change("users", after=user.dict())
     return user
 
+@router.post("/import", response_model=ImportReport)
+async def import_users(file: UploadFile = File(...), format: Optional[Literal["csv", "json"]] = None):
+    """Create users in bulk from a CSV or JSON file, see imports.py
+    
+    Rows failing validation or duplicating an existing email are reported and skipped.
+    """
+    report = await import_rows(db, "users", read_rows(file.file, format or detect_format(file.filename)))
+    statistics_cache.invalidate()
+    return report
+
+@router.get("/export")
+async def export_users(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    since: Optional[datetime] = None,
+    search: Optional[str] = None,
+    department: Optional[str] = None,
+    role: Optional[str] = None,
+    status: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """Stream every user matching the list filters as NDJSON or CSV
+
+    since=<updated_at> only exports the users updated since then, see exports.py.
+    """
+    query = with_search(_user_query(department, role, status), search)
+    return export_response(db.users, query, User, format, "users", since, parse_fields(fields, User))
+
+@router.get("/propagation-jobs/{job_id}", response_model=PropagationJob)
+async def get_propagation_job(job_id: str):
+    """Get the status and progress of a job propagating a rename or delete, see user_propagation.py"""
+    job = await db.propagation_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Propagation job not found")
+    return TrustedJSONResponse(project(job, PropagationJob))
+
 @router.get("/{user_id}", response_model=User)
-async def get_user(user_id: str):
+async def get_user(user_id: str, request: Request, response: Response, fields: Optional[str] = None):
     """Get a specific user by ID"""
-    user = await db.users.find_one({"id": user_id})
+    names = parse_fields(fields, User)
+    user = await db.users.find_one({"id": user_id}, projection(names, "id", *etags.TAGGED_FIELDS["users"]))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return User(**user)
+    return etags.check(request, response, etags.document_etag("users", user, request)) or TrustedJSONResponse(
+        project(user, User, names), headers=response.headers
+    )
 
 @router.put("/{user_id}", response_model=User)
 async def update_user(user_id: str, user_data: UserUpdate):
     """Update a user"""
-    user = await db.users.find_one({"id": user_id})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
     update_data = {k: v for k, v in user_data.dict().items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
     
-    await db.users.update_one({"id": user_id}, {"$set": update_data})
+    # Single atomic write; the previous version feeds the counters and, as the
+    # update only sets fields, applying update_data to it gives the new version
+    try:
+        user = await db.users.find_one_and_update(
+            {"id": user_id},
+            search_update("users", update_data),
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
     
-    updated_user = await db.users.find_one({"id": user_id})
+    updated_user = {**user, **update_data}
+    await record_change("users", before=user, after=updated_user)
+    if updated_user["name"] != user["name"]:
+        # Copies of the old name are rewritten in the background
+        await user_propagation.enqueue(db, user_id, "rename", [user["name"]])
     return User(**updated_user)
 
 @router.delete("/{user_id}")
 async def delete_user(user_id: str):
     """Delete a user"""
-    result = await db.users.delete_one({"id": user_id})
-    if result.deleted_count == 0:
+    user = await db.users.find_one_and_delete({"id": user_id})
+    if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return {"message": "User deleted successfully"}
+    await record_change("users", before=user)
+    if await memberships.remove_user(db, user_id):
+        await record_delta(counters.revision_delta("groups", "group_memberships"))
+    permission_cache.invalidate([user_id])
+    job = await user_propagation.enqueue(db, user_id, "delete", [user["name"], user_id])
+    return {"message": "User deleted successfully", "propagation_job": job.id}
 
 @router.put("/{user_id}/login")
 async def update_last_login(user_id: str):
     """Update user's last login time"""
-    user = await db.users.find_one({"id": user_id})
+    now = datetime.utcnow()
+    # updated_at too, so incremental exports pick the login up
+    user = await db.users.find_one_and_update(
+        {"id": user_id},
+        {"$set": {"last_login": now, "updated_at": now}},
+        projection={"_id": 1}
+    )
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    await record_delta(counters.revision_delta("users"))
+    return {"message": "Last login updated"}
+
+@router.get("/{user_id}/groups", response_model=List[Group])
+async def get_user_groups(
+    user_id: str,
+    request: Request,
+    response: Response,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    """Get the groups of a user, in the order they joined them"""
+    user = await db.users.find_one({"id": user_id}, {"_id": 1})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    await db.users.update_one(
-        {"id": user_id}, 
-        {"$set": {"last_login": datetime.utcnow()}}
+    not_modified = etags.check(request, response, await etags.list_etag(db, request, "group_memberships", "groups"))
+    if not_modified:
+        return not_modified
+    
+    page = await fetch_page(db.group_memberships, {"user_id": user_id}, response, skip=skip, limit=limit, cursor=cursor)
+    groups = {group["id"]: group async for group in db.groups.find({"id": {"$in": [m["group_id"] for m in page]}})}
+    return TrustedJSONResponse(
+        [project(groups[m["group_id"]], Group) for m in page if m["group_id"] in groups], headers=response.headers
     )
-    return {"message": "Last login updated"}
\ No newline at end of file
+
+@router.get("/{user_id}/permissions", response_model=EffectivePermissions)
+async def get_user_permissions(user_id: str):
+    """Get the union of the permissions of the user's active groups, see permissions.py"""
+    user = await db.users.find_one({"id": user_id}, {"_id": 1})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    permissions = await effective_permissions(db, user_id)
+    return EffectivePermissions(user_id=user_id, permissions=sorted(permissions))
+
+@router.get("/{user_id}/propagation-jobs", response_model=List[PropagationJob])
+async def get_user_propagation_jobs(user_id: str, limit: int = Query(20, ge=1, le=100)):
+    """Get the latest jobs propagating the user's renames and deletion, newest first"""
+    jobs = await db.propagation_jobs.find({"user_id": user_id}, {"_id": 0}).sort("created_at", -1).to_list(limit)
+    return TrustedJSONResponse([project(job, PropagationJob) for job in jobs])
\ No newline at end of file
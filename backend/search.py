@@ -0,0 +1,127 @@
+"""Indexed prefix search for the list endpoints.
+
+Searchable fields of every document are folded to lowercase, accent-free
+tokens kept per field in ``search_fields`` and merged into a ``search_terms``
+array backed by a multikey index. Updates recompute the union server side, so
+a single write keeps it in sync without reading the document first. A search
+matches documents having, for each query token, a term starting with it, so
+anchored regexes on already-normalized data are served by the index and
+"equipe" or "Reunion" match "Équipe" and "réunion". Results are ranked by the
+number of query tokens matching a whole term, then by the pagination key.
+"""
+import re
+import unicodedata
+from typing import List, Optional
+
+from fastapi import HTTPException
+from pymongo import UpdateOne
+
+from pagination import SORT
+
+SEARCH_FIELDS = {
+    "users": ["name", "email", "department"],
+    "groups": ["name", "description", "leader"],
+    "equipments": ["name", "type", "serial_number", "assigned_to"],
+    "office_plans": ["name", "description", "created_by"],
+}
+
+BACKFILL_BATCH_SIZE = 500
+
+
+def normalize(text: str) -> str:
+    """Lowercase text and strip its accents"""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", normalize(text))
+
+
+def field_terms(value) -> List[str]:
+    return sorted(set(tokenize(str(value)))) if value else []
+
+
+def search_fields(collection: str, document: dict) -> dict:
+    """Normalized terms of each searchable field of document"""
+    return {field: field_terms(document.get(field)) for field in SEARCH_FIELDS[collection]}
+
+
+def search_terms(collection: str, document: dict) -> List[str]:
+    """Normalized terms of all the searchable fields of document"""
+    terms = set()
+    for values in search_fields(collection, document).values():
+        terms.update(values)
+    return sorted(terms)
+
+
+def with_search_terms(collection: str, document: dict) -> dict:
+    return {
+        **document,
+        "search_fields": search_fields(collection, document),
+        "search_terms": search_terms(collection, document),
+    }
+
+
+def search_update(collection: str, update_data: dict) -> list:
+    """Update pipeline setting update_data and refreshing the search terms it affects"""
+    changes = {key: {"$literal": value} for key, value in update_data.items()}
+    changed_fields = [field for field in SEARCH_FIELDS[collection] if field in update_data]
+    if not changed_fields:
+        return [{"$set": changes}]
+    
+    for field in changed_fields:
+        changes[f"search_fields.{field}"] = {"$literal": field_terms(update_data[field])}
+    union = {"$setUnion": [
+        {"$ifNull": [f"$search_fields.{field}", []]} for field in SEARCH_FIELDS[collection]
+    ]}
+    return [{"$set": changes}, {"$set": {"search_terms": union}}]
+
+
+def search_filter(tokens: List[str]) -> dict:
+    return {"search_terms": {"$all": [re.compile("^" + re.escape(token)) for token in tokens]}}
+
+
+async def search_page(collection, query: dict, search: str, skip: int = 0, limit: int = 100,
+                      projection: Optional[dict] = None, cursor: Optional[str] = None):
+    """Fetch one page of documents matching search, most relevant first
+
+    Ranked results are paged with skip: a cursor, which follows the pagination
+    key, is rejected with a 400 rather than ignored.
+    """
+    if cursor:
+        raise HTTPException(status_code=400, detail="cursor can't be combined with search, page with skip")
+    tokens = tokenize(search)
+    if not tokens:
+        return await collection.find(query, projection).sort(SORT).skip(skip).limit(limit).to_list(limit)
+
+    pipeline = [
+        {"$match": {**query, **search_filter(tokens)}},
+        {"$addFields": {"_score": {"$size": {"$setIntersection": ["$search_terms", tokens]}}}},
+        {"$sort": {"_score": -1, **dict(SORT)}},
+    ]
+    if skip:
+        pipeline.append({"$skip": skip})
+    pipeline.append({"$limit": limit})
+    if projection is not None:
+        pipeline.append({"$project": projection})
+    return await collection.aggregate(pipeline).to_list(limit)
+
+
+async def backfill_search_terms(db):
+    """Compute search_terms for documents written before they existed"""
+    for collection in SEARCH_FIELDS:
+        operations = []
+        async for document in db[collection].find({"search_fields": {"$exists": False}}):
+            operations.append(UpdateOne(
+                {"_id": document["_id"]},
+                {"$set": {
+                    "search_fields": search_fields(collection, document),
+                    "search_terms": search_terms(collection, document),
+                }}
+            ))
+            if len(operations) >= BACKFILL_BATCH_SIZE:
+                await db[collection].bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            await db[collection].bulk_write(operations, ordered=False)
@@ -0,0 +1,70 @@
+"""Trusted-read serialization of documents from our own collections.
+
+Documents are written only after validation against the models, so read
+routes don't need to validate them again: ``project`` keeps the fields of the
+response model, filling the defaults of fields missing from older documents,
+and orjson encodes the result. Returning a ``TrustedJSONResponse`` also skips
+FastAPI's ``response_model`` validation, which stays in the route signature
+for the OpenAPI schema. Writes keep the full model validation.
+
+Read routes also accept ``fields=id,name,...``: the database then only sends
+those fields, and the response only holds them.
+"""
+from functools import lru_cache
+from typing import Any, List, Optional, Tuple
+
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import Response
+from pydantic import BaseModel
+from pydantic.fields import FieldInfo
+
+
+@lru_cache(maxsize=None)
+def response_fields(model: type) -> Tuple[Tuple[str, FieldInfo], ...]:
+    return tuple(model.model_fields.items())
+
+
+def parse_fields(fields: Optional[str], model: type) -> Optional[List[str]]:
+    """Names of the model fields listed in a fields= parameter, None when absent"""
+    if not fields:
+        return None
+    names = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    unknown = [name for name in names if name not in model.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return names
+
+
+def projection(names: Optional[List[str]], *required: str) -> Optional[dict]:
+    """Mongo projection loading names and the required fields, None to load whole documents"""
+    if names is None:
+        return None
+    return {"_id": 0, **{name: 1 for name in (*names, *required)}}
+
+
+def project(document: dict, model: type, names: Optional[List[str]] = None) -> dict:
+    """The fields of model in document, or only names, as the model would serialize them"""
+    fields = response_fields(model) if names is None else [(name, model.model_fields[name]) for name in names]
+    return {
+        name: document[name] if name in document
+        else None if field.is_required() else field.get_default(call_default_factory=True)
+        for name, field in fields
+    }
+
+
+def _default(value: Any):
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    return str(value)
+
+
+def dumps(value: Any) -> bytes:
+    return orjson.dumps(value, default=_default)
+
+
+class TrustedJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
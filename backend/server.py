@@ -7,6 +7,16 @@ import logging
 from pathlib import Path
 from routes import users, groups, equipments, statistics, office_plans
 from models import User, Group, Equipment, OfficePlan, OfficeElement
+from indexes import ensure_indexes
+from counters import ensure_counters
+from search import backfill_search_terms
+from spatial import backfill_spatial_fields
+from plan_history import backfill_plan_snapshots
+from exports import backfill_element_timestamps
+from memberships import backfill_member_counts
+from plan_feed import plan_feed
+from plan_cache import plan_cache
+from user_propagation import user_propagation
 from datetime import datetime
 
 ROOT_DIR = Path(__file__).parent
@@ -44,6 +54,7 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Age", "ETag", "X-Export-Started-At", "X-Next-Cursor"],
 )
 
 # Configure logging
@@ -58,14 +69,28 @@ async def startup_event():
     """Initialize database with sample data if empty"""
     logger.info("Starting up application...")
     
+    await ensure_indexes(db)
+    plan_cache.configure(db)
+    
     # Check if we need to seed data
     user_count = await db.users.count_documents({})
     if user_count == 0:
         logger.info("Seeding database with initial data...")
         await seed_database()
+    
+    await ensure_counters(db)
+    await backfill_search_terms(db)
+    await backfill_spatial_fields(db)
+    await backfill_plan_snapshots(db)
+    await backfill_element_timestamps(db)
+    await backfill_member_counts(db)
+    await plan_feed.start(db)
+    await user_propagation.start(db, statistics.statistics_cache.invalidate)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await plan_feed.stop()
+    await user_propagation.stop()
     client.close()
 
 async def seed_database():
@@ -128,7 +153,6 @@ async def seed_database():
         {
             "name": "Équipe IT",
             "description": "Équipe informatique et développement",
-            "members": 12,
             "leader": "Jean Dupont",
             "status": "Actif",
             "permissions": ["admin", "read", "write"]
@@ -136,7 +160,6 @@ async def seed_database():
         {
             "name": "Ressources Humaines",
             "description": "Gestion du personnel et recrutement",
-            "members": 8,
             "leader": "Marie Martin",
             "status": "Actif",
             "permissions": ["read", "write"]
@@ -144,7 +167,6 @@ async def seed_database():
         {
             "name": "Commercial",
             "description": "Équipe commerciale et ventes",
-            "members": 15,
             "leader": "Pierre Leroy",
             "status": "Actif",
             "permissions": ["read", "write"]
@@ -152,7 +174,6 @@ async def seed_database():
         {
             "name": "Marketing",
             "description": "Communication et marketing digital",
-            "members": 6,
             "leader": "Sophie Bernard",
             "status": "Actif",
             "permissions": ["read", "write"]
@@ -160,7 +181,6 @@ async def seed_database():
         {
             "name": "Direction",
             "description": "Équipe de direction",
-            "members": 3,
             "leader": "Directeur Général",
             "status": "Actif",
             "permissions": ["admin", "read", "write", "delete"]
@@ -0,0 +1,39 @@
+import time
+from typing import Any, Optional, Tuple
+
+
+class SnapshotCache:
+    """Process-level cache holding a single computed value for a limited time
+
+    Writers call invalidate(). A value computed while an invalidation happened
+    is discarded by set(), so a stale snapshot is never stored after a write.
+    """
+
+    def __init__(self):
+        self._value = None
+        self._created_at = 0.0
+        self._generation = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, ttl: float) -> Optional[Tuple[Any, float]]:
+        """Return (value, age in seconds) if a snapshot younger than ttl exists"""
+        if self._value is None:
+            return None
+        age = time.monotonic() - self._created_at
+        if age > ttl:
+            return None
+        return self._value, age
+
+    def set(self, value: Any, generation: int):
+        """Store value if no invalidation happened since generation was read"""
+        if generation != self._generation:
+            return
+        self._value = value
+        self._created_at = time.monotonic()
+
+    def invalidate(self):
+        self._value = None
+        self._generation += 1
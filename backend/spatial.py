@@ -0,0 +1,151 @@
+"""Uniform grid index over office elements.
+
+Elements are rotated around their top-left corner (x, y), clockwise in degrees,
+as the canvas draws them. Each element stores the axis-aligned ``bounds`` of
+its rotated rectangle and the ``cells`` of a CELL_SIZE grid those bounds
+overlap, indexed together with the plan id. A viewport query only scans the
+cells it covers, so its cost follows what is visible rather than plan size.
+Elements overlapping more than MAX_CELLS cells (foundations, long walls) are
+filed under a single OVERSIZED_CELL that every query includes.
+"""
+import math
+from typing import List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+CELL_SIZE = 256  # Pixels, independent of the plan grid_size which only drives snapping
+MAX_CELLS = 64
+MAX_QUERY_CELLS = 1024
+OVERSIZED_CELL = "*"
+# Largest coordinate accepted in queries, far beyond any plan but safe from float overflow
+MAX_COORDINATE = 1e9
+
+GEOMETRY_FIELDS = ("x", "y", "width", "height", "rotation")
+
+BACKFILL_BATCH_SIZE = 500
+
+Box = Tuple[float, float, float, float]  # min_x, min_y, max_x, max_y
+
+
+def corners(element: dict) -> List[Tuple[float, float]]:
+    """Corners of the rotated element, in drawing order"""
+    angle = math.radians(element.get("rotation") or 0)
+    cos, sin = math.cos(angle), math.sin(angle)
+    x, y = element["x"], element["y"]
+    return [
+        (x + u * cos - v * sin, y + u * sin + v * cos)
+        for u, v in ((0, 0), (element["width"], 0), (element["width"], element["height"]), (0, element["height"]))
+    ]
+
+
+def center(element: dict) -> Tuple[float, float]:
+    points = corners(element)
+    return sum(px for px, _ in points) / 4, sum(py for _, py in points) / 4
+
+
+def bounding_box(element: dict) -> Box:
+    points = corners(element)
+    xs = [px for px, _ in points]
+    ys = [py for _, py in points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def cell_range(box: Box) -> Tuple[int, int, int, int]:
+    min_x, min_y, max_x, max_y = box
+    return (
+        math.floor(min_x / CELL_SIZE), math.floor(min_y / CELL_SIZE),
+        math.floor(max_x / CELL_SIZE), math.floor(max_y / CELL_SIZE),
+    )
+
+
+def cell_keys(box: Box, max_cells: int) -> Optional[List[str]]:
+    """Keys of the grid cells overlapped by box, None if there are more than max_cells"""
+    cx0, cy0, cx1, cy1 = cell_range(box)
+    if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > max_cells:
+        return None
+    return [f"{cx}:{cy}" for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)]
+
+
+def spatial_fields(element: dict) -> dict:
+    box = bounding_box(element)
+    return {
+        "bounds": dict(zip(("min_x", "min_y", "max_x", "max_y"), box)),
+        "cells": cell_keys(box, MAX_CELLS) or [OVERSIZED_CELL],
+    }
+
+
+def with_spatial_fields(element: dict) -> dict:
+    return {**element, **spatial_fields(element)}
+
+
+def changes_geometry(update_data: dict) -> bool:
+    return any(field in update_data for field in GEOMETRY_FIELDS)
+
+
+def box_filter(box: Box) -> dict:
+    """Filter matching the elements whose bounds intersect box"""
+    min_x, min_y, max_x, max_y = box
+    query = {
+        "bounds.min_x": {"$lte": max_x},
+        "bounds.max_x": {"$gte": min_x},
+        "bounds.min_y": {"$lte": max_y},
+        "bounds.max_y": {"$gte": min_y},
+    }
+    cells = cell_keys(box, MAX_QUERY_CELLS)
+    if cells is not None:
+        query["cells"] = {"$in": cells + [OVERSIZED_CELL]}
+    return query
+
+
+def valid_coordinate(value: float) -> bool:
+    return math.isfinite(value) and abs(value) <= MAX_COORDINATE
+
+
+def parse_bbox(bbox: str) -> Box:
+    """Parse "x0,y0,x1,y1", raising ValueError when malformed"""
+    values = [float(value) for value in bbox.split(",")]
+    if len(values) != 4 or not all(valid_coordinate(value) for value in values):
+        raise ValueError("bbox must be x0,y0,x1,y1")
+    x0, y0, x1, y1 = values
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+async def nearest_elements(db, plan_id: str, x: float, y: float, k: int, query: dict, max_radius: float,
+                           exclude_id: Optional[str] = None) -> List[Tuple[float, dict]]:
+    """The k elements matching query whose centers are closest to (x, y), with their distance
+
+    Searches squares of growing radius around the point through the grid
+    index. Elements outside a square are farther than its radius, so once k
+    elements lie within it they are the k nearest. Past max_radius the whole
+    plan is searched.
+    """
+    radius = CELL_SIZE
+    while True:
+        exhaustive = radius >= max_radius
+        element_filter = {"office_plan_id": plan_id, **query}
+        if not exhaustive:
+            element_filter.update(box_filter((x - radius, y - radius, x + radius, y + radius)))
+        if exclude_id:
+            element_filter["id"] = {"$ne": exclude_id}
+        
+        found = []
+        async for element in db.office_elements.find(element_filter):
+            distance = math.dist((x, y), center(element))
+            if exhaustive or distance <= radius:
+                found.append((distance, element))
+        if len(found) >= k or exhaustive:
+            found.sort(key=lambda item: (item[0], item[1]["id"]))
+            return found[:k]
+        radius *= 2
+
+
+async def backfill_spatial_fields(db):
+    """Compute the spatial fields of elements written before they existed"""
+    operations = []
+    async for element in db.office_elements.find({"cells": {"$exists": False}}):
+        operations.append(UpdateOne({"_id": element["_id"]}, {"$set": spatial_fields(element)}))
+        if len(operations) >= BACKFILL_BATCH_SIZE:
+            await db.office_elements.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        await db.office_elements.bulk_write(operations, ordered=False)
@@ -0,0 +1,93 @@
+"""Streaming JSON and CSV responses built straight from Motor cursors.
+
+Documents are serialized one at a time as the cursor yields them and flushed
+in chunks of about CHUNK_SIZE bytes, so memory stays bounded whatever the
+number of documents.
+"""
+import csv
+import io
+from typing import Callable, Dict, List, Optional
+
+from fastapi.responses import StreamingResponse
+
+JSON_MEDIA_TYPE = "application/json"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+CSV_MEDIA_TYPE = "text/csv"
+
+CHUNK_SIZE = 64 * 1024
+
+
+async def _iterate(documents):
+    """Iterate a Motor cursor or a plain list alike"""
+    if hasattr(documents, "__aiter__"):
+        async for document in documents:
+            yield document
+    else:
+        for document in documents:
+            yield document
+
+
+async def _chunked(parts):
+    buffer = bytearray()
+    async for part in parts:
+        buffer += part
+        if len(buffer) >= CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+async def json_array(documents, serialize: Callable[[dict], bytes]):
+    yield b"["
+    separator = b""
+    async for document in _iterate(documents):
+        yield separator + serialize(document)
+        separator = b","
+    yield b"]"
+
+
+async def ndjson_lines(documents, serialize: Callable[[dict], bytes]):
+    async for document in _iterate(documents):
+        yield serialize(document) + b"\n"
+
+
+async def csv_lines(documents, columns: List[str], row: Callable[[dict], list]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue().encode()
+    async for document in _iterate(documents):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row(document))
+        yield buffer.getvalue().encode()
+
+
+def stream_csv(documents, columns: List[str], row: Callable[[dict], list],
+               headers: Optional[Dict[str, str]] = None) -> StreamingResponse:
+    """Stream documents as CSV, a header line of columns then one row(document) per document"""
+    return StreamingResponse(_chunked(csv_lines(documents, columns, row)), media_type=CSV_MEDIA_TYPE, headers=headers)
+
+
+def stream_documents(documents, serialize: Callable[[dict], bytes], format: str = "json",
+                     headers: Optional[Dict[str, str]] = None) -> StreamingResponse:
+    """Stream documents as a JSON array, or one JSON document per line with format="ndjson" """
+    if format == "ndjson":
+        return StreamingResponse(_chunked(ndjson_lines(documents, serialize)), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+    return StreamingResponse(_chunked(json_array(documents, serialize)), media_type=JSON_MEDIA_TYPE, headers=headers)
+
+
+def stream_with_array(obj: bytes, field: str, documents, serialize: Callable[[dict], bytes]) -> StreamingResponse:
+    """Stream the serialized JSON object obj with documents appended as its field array"""
+    head = obj.rstrip()[:-1].rstrip()
+    # No comma after an empty object
+    separator = b"" if head == b"{" else b","
+
+    async def parts():
+        yield head + separator + b'"' + field.encode() + b'":'
+        async for part in json_array(documents, serialize):
+            yield part
+        yield b"}"
+
+    return StreamingResponse(_chunked(parts()), media_type=JSON_MEDIA_TYPE)
@@ -0,0 +1,102 @@
+"""Request-scoped batched resolution of user references.
+
+``Equipment.assigned_to``, ``OfficeElement.assigned_to``, ``Group.leader`` and
+``OfficePlan.created_by`` hold a user's name or id as free text. Reads given
+``expand=<field>`` embed the summary of the referenced user next to it, as
+``<field>_user`` (null when no user matches).
+
+A ``UserLoader`` lives for one request. Every key requested while the event
+loop runs the same step is resolved by a single ``$in`` query, and each key is
+resolved at most once per request, so a page of 100 equipment costs one user
+query rather than 100.
+"""
+import asyncio
+from typing import Dict, Iterable, List, Optional
+
+from fastapi import HTTPException
+
+USER_SUMMARY_PROJECTION = {"_id": 0, "id": 1, "name": 1, "email": 1, "department": 1, "role": 1, "status": 1}
+
+EXPAND_BATCH_SIZE = 500
+
+
+def parse_expand(expand: Optional[str], allowed: Iterable[str]) -> List[str]:
+    """Fields listed in an expand= parameter, 400 on fields that can't be expanded"""
+    if not expand:
+        return []
+    fields = list(dict.fromkeys(field.strip() for field in expand.split(",") if field.strip()))
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Cannot expand: {', '.join(unknown)}")
+    return fields
+
+
+class UserLoader:
+    def __init__(self, db):
+        self.db = db
+        self._futures: Dict[str, asyncio.Future] = {}
+        self._queue: List[str] = []
+        self.queries = 0
+
+    def load(self, key: str) -> asyncio.Future:
+        """Future of the summary of the user whose id or name is key"""
+        future = self._futures.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._futures[key] = future
+            self._queue.append(key)
+            if len(self._queue) == 1:
+                # Resolve every key queued during this loop step at once
+                asyncio.get_running_loop().call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+        return future
+
+    async def load_many(self, keys: Iterable[str]) -> Dict[str, Optional[dict]]:
+        keys = list(keys)
+        summaries = await asyncio.gather(*[self.load(key) for key in keys])
+        return dict(zip(keys, summaries))
+
+    async def _dispatch(self):
+        keys, self._queue = self._queue, []
+        self.queries += 1
+        try:
+            found = {}
+            async for user in self.db.users.find(
+                {"$or": [{"id": {"$in": keys}}, {"name": {"$in": keys}}]},
+                USER_SUMMARY_PROJECTION
+            ):
+                # Ids win over homonyms
+                found[user["id"]] = user
+                found.setdefault(user["name"], user)
+        except Exception as exc:
+            for key in keys:
+                if not self._futures[key].done():
+                    self._futures[key].set_exception(exc)
+            return
+        for key in keys:
+            # Skips the futures of requests cancelled meanwhile
+            if not self._futures[key].done():
+                self._futures[key].set_result(found.get(key))
+
+    async def expand(self, documents: List[dict], fields: List[str], results: Optional[List[dict]] = None):
+        """Embed the user referenced by each of fields of documents, into results when given"""
+        if not fields:
+            return
+        results = documents if results is None else results
+        users = await self.load_many({document.get(field) for document in documents for field in fields} - {None})
+        for document, result in zip(documents, results):
+            for field in fields:
+                result[f"{field}_user"] = users.get(document.get(field))
+
+    async def expand_batches(self, documents, fields: List[str], batch_size: int = EXPAND_BATCH_SIZE):
+        """Yield the documents of a cursor with their users embedded, resolving a batch at a time"""
+        batch = []
+        async for document in documents:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                await self.expand(batch, fields)
+                for expanded in batch:
+                    yield expanded
+                batch = []
+        await self.expand(batch, fields)
+        for expanded in batch:
+            yield expanded
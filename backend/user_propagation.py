@@ -0,0 +1,219 @@
+"""Background propagation of user renames and deletes to the documents naming them.
+
+``Equipment.assigned_to``, ``OfficeElement.assigned_to``, ``Group.leader`` and
+``OfficePlan.created_by`` hold a copy of the user's name. ``update_user`` and
+``delete_user`` only enqueue a job in ``propagation_jobs``; a worker then
+rewrites the dependent documents, found through indexes on those fields, with
+one ``bulk_write`` per batch of PROPAGATION_BATCH_SIZE.
+
+A job names the user and the old values to replace. The replacement is the
+user's name when the job runs, or null once the user is deleted, so jobs are
+idempotent and successive renames converge whatever order they run in.
+Equipment of a deleted user is unassigned as ``unassign_equipment`` does it,
+becoming available. Groups and plans keep the name of a deleted user: a group
+needs a leader, and ``created_by`` records who drew the plan. A name that
+another user also bears is left alone, as its copies can't be told apart; the
+job lists it in ``skipped_references``.
+
+Jobs are claimed with a lease renewed after every batch, so a job left running
+by a stopped worker is picked up again. A batch failing with a database error
+is retried PROPAGATION_RETRIES times with exponential backoff before the job
+is marked failed.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import PyMongoError
+
+import counters
+from models import EquipmentStatus, PropagationJob, PropagationJobStatus
+from plan_changes import plan_changed
+from search import search_update
+
+logger = logging.getLogger(__name__)
+
+PROPAGATION_BATCH_SIZE = 500
+PROPAGATION_RETRIES = 3
+RETRY_BASE_SECONDS = 1
+LEASE_SECONDS = 60
+POLL_SECONDS = 10
+
+# Collection -> field holding a copy of the user's name
+REFERENCES = {
+    "equipments": "assigned_to",
+    "office_elements": "assigned_to",
+    "groups": "leader",
+    "office_plans": "created_by",
+}
+# References that can't be cleared when the user is deleted
+REQUIRED_REFERENCES = ("groups", "office_plans")
+
+
+class UserPropagation:
+    def __init__(self):
+        self._db = None
+        self._on_counters_changed: Optional[Callable[[], None]] = None
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+
+    async def enqueue(self, db, user_id: str, kind: str, references: List[str]) -> PropagationJob:
+        """Record a job replacing references to the user and wake the worker up"""
+        job = PropagationJob(user_id=user_id, kind=kind, references=references)
+        await db.propagation_jobs.insert_one(job.dict())
+        self._wakeup.set()
+        return job
+
+    async def start(self, db, on_counters_changed: Optional[Callable[[], None]] = None):
+        """Start the worker, on_counters_changed being called when it moves the statistics counters"""
+        self._db = db
+        self._on_counters_changed = on_counters_changed
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def _claim(self) -> Optional[dict]:
+        """The oldest pending job, or running one whose lease expired, now leased to this worker"""
+        now = datetime.utcnow()
+        return await self._db.propagation_jobs.find_one_and_update(
+            {"$or": [
+                {"status": PropagationJobStatus.PENDING},
+                {"status": PropagationJobStatus.RUNNING, "lease_until": {"$lt": now}},
+            ]},
+            {
+                "$set": {
+                    "status": PropagationJobStatus.RUNNING,
+                    "lease_until": now + timedelta(seconds=LEASE_SECONDS),
+                    "started_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("created_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _run(self):
+        while True:
+            try:
+                job = await self._claim()
+            except PyMongoError:
+                logger.exception("Could not claim a propagation job")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    # Jobs enqueued by other workers are found by polling
+                    await asyncio.wait_for(self._wakeup.wait(), POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._process(job)
+
+    async def _process(self, job: dict):
+        try:
+            user = await self._db.users.find_one({"id": job["user_id"]}, {"_id": 0, "name": 1})
+            replacement = user["name"] if user else None
+            references = [reference for reference in job["references"] if reference != replacement]
+            skipped = await self._db.users.distinct("name", {"name": {"$in": references}, "id": {"$ne": job["user_id"]}})
+            if skipped:
+                await self._db.propagation_jobs.update_one({"id": job["id"]}, {"$set": {"skipped_references": skipped}})
+                references = [reference for reference in references if reference not in skipped]
+            for collection, field in REFERENCES.items():
+                if replacement is None and collection in REQUIRED_REFERENCES:
+                    continue
+                await self._propagate(job, collection, field, references, replacement)
+        except Exception as exc:
+            logger.exception("Propagation job %s failed", job["id"])
+            await self._db.propagation_jobs.update_one({"id": job["id"]}, {"$set": {
+                "status": PropagationJobStatus.FAILED, "error": str(exc), "finished_at": datetime.utcnow()
+            }})
+            return
+        await self._db.propagation_jobs.update_one({"id": job["id"]}, {"$set": {
+            "status": PropagationJobStatus.DONE, "error": None, "finished_at": datetime.utcnow()
+        }})
+
+    async def _propagate(self, job: dict, collection: str, field: str, references: List[str], replacement: Optional[str]):
+        """Replace references in field of collection, a batch at a time until none is left"""
+        if not references:
+            return
+        while True:
+            documents = await self._retry(lambda: self._db[collection].find(
+                {field: {"$in": references}}, {"_id": 0, "id": 1, "office_plan_id": 1, "status": 1}
+            ).limit(PROPAGATION_BATCH_SIZE).to_list(PROPAGATION_BATCH_SIZE))
+            if not documents:
+                return
+            await self._retry(lambda: self._apply(collection, field, documents, references, replacement))
+            await self._db.propagation_jobs.update_one({"id": job["id"]}, {
+                "$inc": {f"progress.{collection}": len(documents)},
+                "$set": {"lease_until": datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)},
+            })
+
+    async def _unassign(self, documents: List[dict], references: List[str]):
+        """Unassign equipment of a deleted user, moving the status counters by the documents actually updated"""
+        changes = {"assigned_to": None, "status": EquipmentStatus.DISPONIBLE.value, "updated_at": datetime.utcnow()}
+        by_status: Dict[Optional[str], List[str]] = {}
+        for document in documents:
+            by_status.setdefault(document.get("status"), []).append(document["id"])
+        for status, ids in by_status.items():
+            # One write per previous status, so the number updated gives the counter changes
+            result = await self._db.equipments.update_many(
+                {"id": {"$in": ids}, "assigned_to": {"$in": references}, "status": status},
+                search_update("equipments", changes)
+            )
+            await counters.apply_delta(self._db, counters.merge_deltas(
+                counters.revision_delta("equipments") if result.modified_count else {},
+                counters.counter_delta("equipments", {"status": status}, -result.modified_count),
+                counters.counter_delta("equipments", changes, result.modified_count)
+            ))
+        if self._on_counters_changed:
+            self._on_counters_changed()
+
+    async def _apply(self, collection: str, field: str, documents: List[dict], references: List[str],
+                     replacement: Optional[str]):
+        if collection == "equipments" and replacement is None:
+            await self._unassign(documents, references)
+            return
+        changes = {field: replacement, "updated_at": datetime.utcnow()}
+        # Elements have no search terms
+        update = {"$set": changes} if collection == "office_elements" else search_update(collection, changes)
+        await self._db[collection].bulk_write([
+            # Matching the reference again leaves documents reassigned meanwhile alone
+            UpdateOne({"id": document["id"], field: {"$in": references}}, update)
+            for document in documents
+        ], ordered=False)
+        await counters.apply_delta(self._db, counters.revision_delta(collection))
+
+        # Elements and plans are versioned: bump the plans they changed
+        if collection == "office_elements":
+            ops: Dict[str, List[dict]] = {}
+            for document in documents:
+                ops.setdefault(document["office_plan_id"], []).append(
+                    {"op": "update", "id": document["id"], "changes": {field: replacement}}
+                )
+            for plan_id, plan_ops in ops.items():
+                await plan_changed(self._db, plan_id, plan_ops)
+        elif collection == "office_plans":
+            for document in documents:
+                await plan_changed(self._db, document["id"], [{"op": "plan", "changes": {field: replacement}}])
+
+    async def _retry(self, operation):
+        for attempt in range(PROPAGATION_RETRIES + 1):
+            try:
+                return await operation()
+            except PyMongoError:
+                if attempt == PROPAGATION_RETRIES:
+                    raise
+                logger.warning("Propagation batch failed, retrying", exc_info=True)
+                await asyncio.sleep(RETRY_BASE_SECONDS * 2 ** attempt)
+
+
+user_propagation = UserPropagation()
@@ -19,6 +19,8 @@ export const usersAPI = {
   update: (id, userData) => api.put(`/users/${id}`, userData),
   delete: (id) => api.delete(`/users/${id}`),
   updateLastLogin: (id) => api.put(`/users/${id}/login`),
+  getGroups: (id, params = {}) => api.get(`/users/${id}/groups`, { params }),
+  getPermissions: (id) => api.get(`/users/${id}/permissions`),
 };
 
 // Groups API
@@ -30,6 +32,9 @@ export const groupsAPI = {
   delete: (id) => api.delete(`/groups/${id}`),
   addMember: (groupId, userId) => api.post(`/groups/${groupId}/members/${userId}`),
   removeMember: (groupId, userId) => api.delete(`/groups/${groupId}/members/${userId}`),
+  getMembers: (groupId, params = {}) => api.get(`/groups/${groupId}/members`, { params }),
+  addMembers: (groupId, userIds) => api.post(`/groups/${groupId}/members`, { user_ids: userIds }),
+  removeMembers: (groupId, userIds) => api.delete(`/groups/${groupId}/members`, { data: { user_ids: userIds } }),
 };
 
 // Equipments API
@@ -47,6 +52,9 @@ export const equipmentsAPI = {
 export const officePlansAPI = {
   getAll: (params = {}) => api.get('/office-plans', { params }),
   getById: (id) => api.get(`/office-plans/${id}`),
+  getAtVersion: (id, version) => api.get(`/office-plans/${id}`, { params: { at: version } }),
+  getVersions: (id, params) => api.get(`/office-plans/${id}/versions`, { params }),
+  revert: (id, version) => api.post(`/office-plans/${id}/revert`, null, { params: { version } }),
   create: (planData) => api.post('/office-plans', planData),
   update: (id, planData) => api.put(`/office-plans/${id}`, planData),
   delete: (id) => api.delete(`/office-plans/${id}`),
@@ -54,10 +62,15 @@ export const officePlansAPI = {
     params: { new_name: newName, created_by: createdBy }
   }),
   // Elements management
-  getElements: (planId) => api.get(`/office-plans/${planId}/elements`),
+  getElements: (planId, params = {}) => api.get(`/office-plans/${planId}/elements`, { params }),
   addElement: (planId, elementData) => api.post(`/office-plans/${planId}/elements`, elementData),
   updateElement: (planId, elementId, elementData) => api.put(`/office-plans/${planId}/elements/${elementId}`, elementData),
   deleteElement: (planId, elementId) => api.delete(`/office-plans/${planId}/elements/${elementId}`),
+  getNearestDesks: (planId, x, y, k = 5) => api.get(`/office-plans/${planId}/desks/nearest`, { params: { x, y, k } }),
+  batchElements: (planId, operations) => api.post(`/office-plans/${planId}/elements:batch`, { operations }),
+  openFeed: (planId, since) => new WebSocket(
+    `${API.replace(/^http/, 'ws')}/office-plans/${planId}/feed${since != null ? `?since=${since}` : ''}`
+  ),
 };
 
 // Statistics API
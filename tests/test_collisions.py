@@ -0,0 +1,82 @@
+import asyncio
+
+from collisions import batch_collisions, can_collide, overlaps
+
+
+def desk(x, y, width=100, height=50, rotation=0, id="desk"):
+    return {"id": id, "type": "desk", "x": x, "y": y, "width": width, "height": height, "rotation": rotation}
+
+
+def test_overlapping_rectangles_collide():
+    assert overlaps(desk(0, 0), desk(50, 25))
+
+
+def test_separate_rectangles_do_not_collide():
+    assert not overlaps(desk(0, 0), desk(200, 0))
+
+
+def test_touching_edges_do_not_collide():
+    assert not overlaps(desk(0, 0), desk(100, 0))
+    assert not overlaps(desk(0, 0), desk(0, 50))
+
+
+def test_rotation_moves_the_rectangle_around_its_top_left_corner():
+    # Turned a quarter clockwise, the desk covers x in [-50, 0] and y in [0, 100]
+    rotated = desk(0, 0, rotation=90)
+    assert overlaps(rotated, desk(-40, 60, width=20, height=20))
+    assert not overlaps(rotated, desk(20, 10, width=20, height=20))
+
+
+def test_rotated_rectangles_whose_bounding_boxes_intersect_may_not_collide():
+    # Both diagonals have intersecting bounds, but a separating axis between them
+    a = desk(0, 0, width=200, height=10, rotation=45)
+    b = desk(120, 0, width=200, height=10, rotation=45)
+    assert not overlaps(a, b)
+
+
+def test_contained_rectangle_collides():
+    assert overlaps(desk(0, 0, width=400, height=400), desk(100, 100, width=10, height=10))
+
+
+def test_ignored_types_never_collide():
+    assert not can_collide(desk(0, 0), {**desk(0, 0), "type": "chair"})
+    assert not can_collide({**desk(0, 0), "type": "foundation"}, desk(0, 0))
+
+
+def test_walls_cross_each_other_but_not_desks():
+    wall = {**desk(0, 0), "type": "wall"}
+    assert not can_collide(wall, {**wall, "id": "other"})
+    assert can_collide(wall, desk(0, 0))
+
+
+class StoredElements:
+    """office_elements stand-in returning the stored elements the query doesn't exclude by id"""
+
+    def __init__(self, elements):
+        self.elements = elements
+
+    def find(self, query, projection=None):
+        excluded = set(query["id"]["$nin"])
+        found = [element for element in self.elements if element["id"] not in excluded]
+
+        class Cursor:
+            async def to_list(self, length):
+                return found
+        return Cursor()
+
+
+class Database:
+    def __init__(self, elements):
+        self.office_elements = StoredElements(elements)
+
+
+def test_batch_rechecks_moves_against_the_place_of_rejected_elements():
+    db = Database([desk(0, 0, id="a"), desk(300, 0, id="b"), desk(600, 0, id="c")])
+    # a can't land on c, so it stays where b wants to go
+    collisions = asyncio.run(batch_collisions(db, "plan", [desk(600, 0, id="a"), desk(0, 0, id="b")]))
+    assert collisions == {"a": ["c"], "b": ["a"]}
+
+
+def test_batch_accepts_elements_swapping_places():
+    db = Database([desk(0, 0, id="a"), desk(300, 0, id="b")])
+    assert asyncio.run(batch_collisions(db, "plan", [desk(300, 0, id="a"), desk(0, 0, id="b")])) == {}
@@ -0,0 +1,64 @@
+import io
+import json
+
+import imports
+from imports import read_rows
+
+
+def rows(data: bytes, format: str = "json"):
+    return list(read_rows(io.BytesIO(data), format))
+
+
+def test_json_array_and_json_lines_give_the_same_rows():
+    objects = [{"name": "Écran"}, {"name": "Clavier"}]
+    expected = [(1, objects[0], None), (2, objects[1], None)]
+    assert rows(json.dumps(objects).encode()) == expected
+    assert rows("\n".join(json.dumps(item) for item in objects).encode()) == expected
+
+
+def test_objects_cut_across_reads_are_decoded(monkeypatch):
+    monkeypatch.setattr(imports, "READ_SIZE", 7)
+    objects = [{"name": f"Écran {number}", "serial_number": f"SN-{number}"} for number in range(20)]
+    assert [values for _, values, _ in rows(json.dumps(objects, ensure_ascii=False).encode())] == objects
+
+
+def test_byte_order_mark_is_skipped():
+    assert rows(b'\xef\xbb\xbf[{"name": "a"}]') == [(1, {"name": "a"}, None)]
+
+
+def test_non_objects_are_reported():
+    assert rows(b'[{"name": "a"}, 3]') == [(1, {"name": "a"}, None), (2, None, "Expected a JSON object")]
+
+
+def test_invalid_json_line_is_reported_and_skipped():
+    result = rows(b'{"name": "a"}\n{"name": \n{"name": "c"}\n')
+    assert [values for _, values, _ in result] == [{"name": "a"}, None, {"name": "c"}]
+    assert result[1][0] == 2 and result[1][2].startswith("Invalid JSON")
+
+
+def test_invalid_json_line_cut_across_reads_is_skipped(monkeypatch):
+    monkeypatch.setattr(imports, "READ_SIZE", 4)
+    result = rows(b'{"name": "a"}\n{"name": oops, "serial_number": "SN"}\n{"name": "c"}')
+    assert [values for _, values, _ in result] == [{"name": "a"}, None, {"name": "c"}]
+
+
+def test_invalid_json_array_stops_at_once(monkeypatch):
+    monkeypatch.setattr(imports, "READ_SIZE", 16)
+    data = b'[{"name": "a"}, {"name": oops}, ' + b", ".join(b'{"name": "x"}' for _ in range(1000)) + b"]"
+    file = io.BytesIO(data)
+    result = list(read_rows(file, "json"))
+    assert result[0] == (1, {"name": "a"}, None)
+    assert result[1][0] == 2 and result[1][2].startswith("Invalid JSON")
+    assert len(result) == 2
+    assert file.tell() < 100
+
+
+def test_oversized_rows_are_reported(monkeypatch):
+    monkeypatch.setattr(imports, "MAX_ROW_SIZE", 64)
+    monkeypatch.setattr(imports, "READ_SIZE", 16)
+    result = rows(b'{"name": "' + b"a" * 200 + b'"}\n{"name": "b"}\n')
+    assert result == [(1, None, "Row longer than 64 characters"), (2, {"name": "b"}, None)]
+
+
+def test_csv_empty_cells_are_dropped():
+    assert rows(b"name,serial_number\nEcran,\n", "csv") == [(1, {"name": "Ecran"}, None)]
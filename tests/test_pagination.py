@@ -0,0 +1,36 @@
+import base64
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+from pagination import after_cursor, decode_cursor, encode_cursor
+
+
+def test_cursor_round_trips_the_sort_key():
+    created_at = datetime(2024, 3, 1, 12, 30, 15, 123456)
+    cursor = encode_cursor({"created_at": created_at, "id": "a-1"})
+    assert decode_cursor(cursor) == (created_at, "a-1")
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_cursor({"created_at": datetime(2024, 1, 1), "id": "?>>?"})
+    assert not set(cursor) & set("+/")
+
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor",
+    base64.urlsafe_b64encode(b'["not a date", "a-1"]').decode(),
+    base64.urlsafe_b64encode(b'{"created_at": 1}').decode(),
+])
+def test_invalid_cursors_are_rejected_with_400(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor)
+    assert error.value.status_code == 400
+
+
+def test_after_cursor_keeps_the_query():
+    cursor = encode_cursor({"created_at": datetime(2024, 1, 1), "id": "a-1"})
+    assert after_cursor({"status": "Actif"}, None) == {"status": "Actif"}
+    assert after_cursor({"status": "Actif"}, cursor)["$and"][0] == {"status": "Actif"}
+    assert after_cursor({}, cursor)["$or"][1] == {"created_at": datetime(2024, 1, 1), "id": {"$gt": "a-1"}}
@@ -0,0 +1,33 @@
+import asyncio
+
+from plan_feed import PlanFeed
+
+
+def publish(feed: PlanFeed, plan_id: str, *seqs: int):
+    for seq in seqs:
+        asyncio.run(feed.publish(None, plan_id, seq, [{"op": "delete", "id": f"element-{seq}"}]))
+
+
+def test_missed_returns_the_messages_after_since():
+    feed = PlanFeed()
+    publish(feed, "plan", 1, 2, 3)
+    missed = asyncio.run(feed.missed(None, "plan", 1, 3))
+    assert [message["seq"] for message in missed] == [2, 3]
+
+
+def test_missed_is_empty_when_up_to_date():
+    feed = PlanFeed()
+    publish(feed, "plan", 1, 2)
+    assert asyncio.run(feed.missed(None, "plan", 2, 2)) == []
+
+
+def test_missed_requires_a_snapshot_when_since_is_ahead_of_the_plan():
+    feed = PlanFeed()
+    publish(feed, "plan", 1, 2)
+    assert asyncio.run(feed.missed(None, "plan", 5, 2)) is None
+
+
+def test_missed_requires_a_snapshot_when_messages_are_gone():
+    feed = PlanFeed()
+    publish(feed, "plan", 3, 4)
+    assert asyncio.run(feed.missed(None, "plan", 1, 4)) is None
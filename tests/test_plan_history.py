@@ -0,0 +1,42 @@
+from plan_history import apply_ops, summarize
+
+
+def elements(*ids):
+    return {id: {"id": id, "x": 0} for id in ids}
+
+
+def test_apply_ops_replays_element_operations_in_order():
+    plan, state = {"name": "Étage 1"}, elements("a", "b")
+    apply_ops(plan, state, [
+        {"op": "update", "id": "a", "changes": {"x": 10}},
+        {"op": "delete", "id": "b"},
+        {"op": "create", "id": "c", "element": {"id": "c", "x": 5}},
+        {"op": "update", "id": "c", "changes": {"x": 6}},
+    ])
+    assert state == {"a": {"id": "a", "x": 10}, "c": {"id": "c", "x": 6}}
+    assert plan == {"name": "Étage 1"}
+
+
+def test_apply_ops_updates_the_plan():
+    plan = {"name": "Étage 1", "grid_size": 20}
+    apply_ops(plan, {}, [{"op": "plan", "changes": {"name": "Étage 2"}}])
+    assert plan == {"name": "Étage 2", "grid_size": 20}
+
+
+def test_apply_ops_ignores_operations_on_missing_elements():
+    state = elements("a")
+    apply_ops({}, state, [{"op": "update", "id": "gone", "changes": {"x": 1}}, {"op": "delete", "id": "gone"}])
+    assert state == elements("a")
+
+
+def test_created_elements_are_copied():
+    element = {"id": "a", "x": 0}
+    state = {}
+    apply_ops({}, state, [{"op": "create", "id": "a", "element": element}, {"op": "update", "id": "a", "changes": {"x": 1}}])
+    assert element == {"id": "a", "x": 0}
+
+
+def test_summarize_counts_operations():
+    assert summarize([
+        {"op": "create"}, {"op": "create"}, {"op": "delete"}, {"op": "plan"},
+    ]) == {"created": 2, "updated": 0, "deleted": 1, "plan_updated": True}
@@ -0,0 +1,39 @@
+import asyncio
+import re
+
+import pytest
+from fastapi import HTTPException
+
+from search import normalize, search_filter, search_page, search_terms, search_update, tokenize
+
+
+def test_normalize_strips_accents_and_case():
+    assert normalize("Équipe Réunion") == "equipe reunion"
+
+
+def test_tokenize_splits_on_punctuation():
+    assert tokenize("Jean-Pierre, salle B2!") == ["jean", "pierre", "salle", "b2"]
+
+
+def test_search_terms_merge_the_searchable_fields():
+    user = {"name": "Élise Martin", "email": "elise@example.com", "department": None, "role": "Admin"}
+    assert search_terms("users", user) == ["com", "elise", "example", "martin"]
+
+
+def test_search_filter_anchors_and_escapes_tokens():
+    pattern = search_filter(tokenize("a.b"))["search_terms"]["$all"]
+    assert [token.pattern for token in pattern] == ["^a", "^b"]
+    assert isinstance(pattern[0], re.Pattern)
+
+
+def test_search_update_refreshes_only_changed_fields():
+    assert search_update("equipments", {"status": "Disponible"}) == [{"$set": {"status": {"$literal": "Disponible"}}}]
+    pipeline = search_update("equipments", {"assigned_to": None})
+    assert pipeline[0]["$set"]["search_fields.assigned_to"] == {"$literal": []}
+    assert "search_terms" in pipeline[1]["$set"]
+
+
+def test_search_page_rejects_cursors():
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(search_page(None, {}, "martin", cursor="abc"))
+    assert error.value.status_code == 400
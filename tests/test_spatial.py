@@ -0,0 +1,45 @@
+import pytest
+
+from spatial import CELL_SIZE, MAX_CELLS, OVERSIZED_CELL, bounding_box, cell_keys, center, parse_bbox, spatial_fields
+
+
+def test_cell_keys_lists_every_overlapped_cell():
+    assert cell_keys((10, 10, CELL_SIZE + 10, 20), MAX_CELLS) == ["0:0", "1:0"]
+
+
+def test_cell_keys_floors_negative_coordinates():
+    assert cell_keys((-10, -10, 10, 10), MAX_CELLS) == ["-1:-1", "-1:0", "0:-1", "0:0"]
+
+
+def test_cell_keys_is_none_past_max_cells():
+    box = (0, 0, 3 * CELL_SIZE - 1, 3 * CELL_SIZE - 1)
+    assert len(cell_keys(box, 9)) == 9
+    assert cell_keys(box, 8) is None
+
+
+def test_oversized_elements_are_filed_under_a_single_cell():
+    wall = {"x": 0, "y": 0, "width": 100 * CELL_SIZE, "height": 10 * CELL_SIZE, "rotation": 0}
+    assert spatial_fields(wall)["cells"] == [OVERSIZED_CELL]
+
+
+def test_bounds_and_center_follow_the_rotation():
+    element = {"x": 0, "y": 0, "width": 100, "height": 50, "rotation": 90}
+    assert bounding_box(element) == pytest.approx((-50, 0, 0, 100))
+    assert center(element) == pytest.approx((-25, 50))
+
+
+def test_parse_bbox_orders_the_corners():
+    assert parse_bbox("10,20,0,5") == (0, 5, 10, 20)
+
+
+def test_parse_bbox_rejects_malformed_values():
+    with pytest.raises(ValueError):
+        parse_bbox("1,2,3")
+    with pytest.raises(ValueError):
+        parse_bbox("a,b,c,d")
+
+
+@pytest.mark.parametrize("bbox", ["0,0,inf,5", "nan,0,1,1", "0,-1e308,1,1"])
+def test_parse_bbox_rejects_non_finite_and_huge_values(bbox):
+    with pytest.raises(ValueError):
+        parse_bbox(bbox)
@@ -0,0 +1,34 @@
+import asyncio
+import json
+
+from models import OfficePlan
+from serialization import dumps, project
+from streaming import stream_with_array
+
+
+def body(response) -> bytes:
+    async def collect():
+        return b"".join([part async for part in response.body_iterator])
+    return asyncio.run(collect())
+
+
+def element_json(element: dict) -> bytes:
+    return dumps(element)
+
+
+def test_stream_with_array_appends_the_array_to_the_object():
+    response = stream_with_array(dumps({"id": "plan", "name": "Plan"}), "elements", [{"id": "a"}, {"id": "b"}], element_json)
+    assert json.loads(body(response)) == {"id": "plan", "name": "Plan", "elements": [{"id": "a"}, {"id": "b"}]}
+
+
+def test_stream_with_array_without_elements():
+    response = stream_with_array(dumps({"id": "plan"}), "elements", [], element_json)
+    assert json.loads(body(response)) == {"id": "plan", "elements": []}
+
+
+def test_fields_elements_streams_valid_json():
+    # fields=elements: the plan head holds no other field once elements are popped
+    plan = project({"id": "plan", "name": "Plan", "created_by": "Jean Dupont"}, OfficePlan, ["elements"])
+    plan.pop("elements")
+    response = stream_with_array(dumps(plan), "elements", [{"id": "a"}], element_json)
+    assert json.loads(body(response)) == {"elements": [{"id": "a"}]}